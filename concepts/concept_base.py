@@ -1,13 +1,17 @@
 from abc import ABC, abstractmethod
-from typing import Tuple, List
+from collections.abc import Mapping
+from typing import Tuple, List, Dict, Callable
 
 import numpy as np
 from actions import Actions
+from concepts.concept_cache import ConceptCache
 
 ActionResult = Tuple[any, any]
 
 
 class ConceptItemBase(ABC):
+    __slots__ = ()
+
     @abstractmethod
     def check(self, item) -> any:
         pass
@@ -24,6 +28,75 @@ class ConceptItemBase(ABC):
 ConceptList = List[ConceptItemBase]
 
 
+def smallest_int_dtype(min_value: int, max_value: int) -> np.dtype:
+    """
+    Smallest signed integer type that is able to hold all values between min_value and max_value
+    """
+    for dtype in [np.int8, np.int16, np.int32, np.int64]:
+        info = np.iinfo(dtype)
+        if info.min <= min_value and max_value <= info.max:
+            return np.dtype(dtype)
+
+    raise ValueError("values between %d and %d do not fit into an integer type" % (min_value, max_value))
+
+
+class ActionValues(Mapping):
+    """
+    Dict-style adapter on the (actions x hypotheses) table, mapping a raw RL action to its row of concept values
+    """
+
+    def __init__(self, action_index: Dict[any, int], table: np.ndarray):
+        self.action_index = action_index
+        self.table = table
+
+    def __getitem__(self, action) -> np.ndarray:
+        return self.table[self.action_index[action]]
+
+    def __iter__(self):
+        return iter(self.action_index)
+
+    def __len__(self):
+        return len(self.action_index)
+
+
+class ObservationPartition:
+    """
+    Hypothesis indices of one action grouped by the observation value they produce, in CSR layout: the hypotheses
+    with observation i are indices[offsets[i]:offsets[i + 1]] (sorted ascending). Values that are not part of the
+    observation space are collected in a trailing extra group.
+    """
+
+    def __init__(self, values: np.ndarray, observation_lookup: np.ndarray, value_offset: int, observation_count: int):
+        observation_ids = observation_lookup[values.astype(np.int64) - value_offset]
+
+        self.indices = np.argsort(observation_ids, kind='stable')
+        self.counts = np.bincount(observation_ids, minlength=observation_count + 1)
+        self.offsets = np.concatenate([[0], np.cumsum(self.counts)])
+
+        self.observation_count = observation_count
+
+    def consistent(self, observation_id: int) -> np.ndarray:
+        """
+        Indices of all hypotheses producing the observation with the given id (empty for None)
+        """
+        if observation_id is None:
+            return self.indices[:0]
+
+        return self.indices[self.offsets[observation_id]:self.offsets[observation_id + 1]]
+
+    def sums(self, weights: np.ndarray) -> np.ndarray:
+        """
+        Sum of the weights of the hypotheses of every observation
+        """
+        # trailing 0 so that every group start is a valid index, even for empty groups at the end
+        sorted_weights = np.append(weights[self.indices], 0)
+
+        sums = np.add.reduceat(sorted_weights, self.offsets[:-1])
+        sums[self.counts == 0] = 0
+
+        return sums[:self.observation_count]
+
+
 class ConceptBase(ABC):
     ACTION_COSTS = {
         Actions.EXAMPLE: 1.0,
@@ -41,16 +114,140 @@ class ConceptBase(ABC):
         'continuous': 0.0,
     }
 
+    # optional on-disk cache for the precomputed tables, set by subclasses before generating their concept space
+    cache: ConceptCache = None
+
     def __init__(self):
-        # pre-calculate state-action concept values
-        self.state_action_values = {}
+        # dense integer index of every RL action
+        self.rl_actions = list(self.get_rl_actions())
+        self.action_index = {action: idx for idx, action in enumerate(self.rl_actions)}
+
+        # pre-calculate state-action concept values as one contiguous (actions x hypotheses) table
+        self.action_values = None
         self.pre_calc_state_values()
+        self.state_action_values = ActionValues(self.action_index, self.action_values)
+
+        # observation partitions and prior sums per action, created on first use
+        self.observation_index = {value: idx for idx, value in enumerate(self.get_observation_space())}
+        self.observation_lookup, self.observation_value_offset = self.create_observation_lookup()
+        self.partitions = {}
+        self.prior_sums = {}
+
+        # default prior converted to other float precisions, created on first use
+        self.typed_priors = {}
 
     def pre_calc_state_values(self):
-        for action in self.get_rl_actions():
-            self.state_action_values[action] = np.zeros(len(self.get_concept_space()))
+        def build_action_values():
+            values = self.calc_action_values()
+            dtype = smallest_int_dtype(np.min(values), np.max(values))
+
+            return np.ascontiguousarray(values, dtype=dtype)
+
+        self.action_values = self.fetch_table('action_values', build_action_values)
+
+    def calc_action_values(self) -> np.ndarray:
+        values = np.zeros((len(self.rl_actions), len(self.get_concept_space())), dtype=int)
+        for action_idx, action in enumerate(self.rl_actions):
             for idx, state in enumerate(self.get_concept_space()):
-                self.state_action_values[action][idx] = self.evaluate_concept(action, state, idx)
+                values[action_idx, idx] = self.evaluate_concept(action, state)
+
+        return values
+
+    def get_cache_config(self) -> dict:
+        """
+        Task configuration which fully determines the precomputed tables, used as key for the concept cache
+        """
+        return {}
+
+    def fetch_table(self, name: str, builder: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Get a precomputed table from the concept cache (read-only and memory-mapped) or build it if there is no cache
+        """
+        if self.cache is None:
+            return builder()
+
+        return self.cache.fetch(type(self), self.get_cache_config(), name, builder)
+
+    def create_observation_lookup(self) -> (np.ndarray, int):
+        """
+        Array mapping every value of the action table (shifted by the min value) to its observation id
+        """
+        min_value, max_value = int(np.min(self.action_values)), int(np.max(self.action_values))
+
+        lookup = np.full(max_value - min_value + 1, len(self.observation_index))
+        for value, idx in self.observation_index.items():
+            if min_value <= value <= max_value:
+                lookup[int(value) - min_value] = idx
+
+        return lookup, min_value
+
+    def get_observation_idx(self, observation) -> int:
+        return self.observation_index.get(observation)
+
+    def get_partition(self, action) -> ObservationPartition:
+        """
+        Hypotheses of the action grouped by observation (see ObservationPartition), computed once per action
+        """
+        action_idx = self.action_index[action]
+
+        partition = self.partitions.get(action_idx)
+        if partition is None:
+            partition = ObservationPartition(self.action_values[action_idx], self.observation_lookup,
+                                             self.observation_value_offset, len(self.observation_index))
+            self.partitions[action_idx] = partition
+
+        return partition
+
+    def get_consistent_indices(self, action, observation) -> np.ndarray:
+        return self.get_partition(action).consistent(self.get_observation_idx(observation))
+
+    def get_prior_sums(self, action) -> np.ndarray:
+        """
+        Sum of the default prior of the consistent hypotheses for every observation of the action
+        """
+        action_idx = self.action_index[action]
+
+        prior_sums = self.prior_sums.get(action_idx)
+        if prior_sums is None:
+            prior = self.get_default_prior()
+            partition = self.get_partition(action)
+
+            prior_sums = np.array([np.sum(prior[partition.consistent(idx)])
+                                   for idx in range(len(self.observation_index))])
+            self.prior_sums[action_idx] = prior_sums
+
+        return prior_sums
+
+    def get_prior(self, dtype=np.float64) -> np.ndarray:
+        """
+        Default prior in the given float precision, converted once per precision
+        """
+        prior = self.get_default_prior()
+        dtype = np.dtype(dtype)
+        if prior.dtype == dtype:
+            return prior
+
+        typed_prior = self.typed_priors.get(dtype)
+        if typed_prior is None:
+            typed_prior = prior.astype(dtype)
+            self.typed_priors[dtype] = typed_prior
+
+        return typed_prior
+
+    def get_shared_tables(self) -> List[np.ndarray]:
+        """
+        Large read-only tables, which worker processes can map from shared memory instead of receiving a copy
+        """
+        return [self.action_values, self.get_default_prior()] + list(self.typed_priors.values())
+
+    def get_action_index(self, action) -> int:
+        return self.action_index[action]
+
+    def get_action_values(self, actions: iter) -> np.ndarray:
+        """
+        Concept values of several actions at once, as (actions x hypotheses) array
+        """
+        return self.action_values[[self.action_index[action] for action in actions]]
 
     @abstractmethod
     def assess(self, learner) -> (bool, float):
@@ -68,6 +265,13 @@ class ConceptBase(ABC):
     def get_default_prior(self) -> np.ndarray:
         pass
 
+    def get_uniform_distribution(self) -> np.ndarray:
+        """
+        Uniform distribution over the hypotheses
+        """
+        concept_count = len(self.get_concept_space())
+        return np.full(concept_count, 1 / concept_count)
+
     def teaching_action(self, action_type: Actions) -> ActionResult:
         if action_type == Actions.EXAMPLE:
             return self.generate_example()
@@ -100,6 +304,16 @@ class ConceptBase(ABC):
     def evaluate_concept(self, action: any, concept=None, idx: int = None):
         pass
 
+    def evaluate_concepts(self, action: any, indices=None) -> np.ndarray:
+        """
+        Values of the action for the hypotheses at the given indices (all hypotheses if None), from the action table
+        """
+        values = self.action_values[self.action_index[action]]
+        if indices is None:
+            return values
+
+        return values[indices]
+
     @abstractmethod
     def gen_readable_format(self, result: ActionResult, show_answer=True):
         pass
@@ -0,0 +1,67 @@
+import hashlib
+import inspect
+import json
+import os
+from functools import lru_cache
+from pathlib import Path
+from typing import Callable
+
+import numpy as np
+
+
+class ConceptCache:
+    """
+    Content-addressed on-disk cache of the precomputed concept tables (hypotheses, prior, action values).
+
+    Every task configuration maps to its own directory, named after a hash of the concept class, its configuration
+    and the source code of the concept modules. Arrays are stored as .npy files and opened memory-mapped, so that
+    repeated runs and parallel workers share the same pages instead of recomputing the tables.
+    """
+
+    def __init__(self, cache_dir: str = 'data/cache'):
+        self.cache_dir = Path(cache_dir)
+
+    @staticmethod
+    @lru_cache(maxsize=None)
+    def code_version(concept_class: type) -> str:
+        version = hashlib.sha1()
+        for cls in concept_class.__mro__:
+            try:
+                source_file = inspect.getsourcefile(cls)
+            except TypeError:
+                # builtin classes
+                continue
+
+            if source_file is not None:
+                version.update(Path(source_file).read_bytes())
+
+        return version.hexdigest()
+
+    def get_path(self, concept_class: type, config: dict) -> Path:
+        key = json.dumps({
+            'concept': concept_class.__name__,
+            'config': config,
+            'version': self.code_version(concept_class)
+        }, sort_keys=True)
+
+        return self.cache_dir / "{}-{}".format(concept_class.__name__, hashlib.sha1(key.encode()).hexdigest()[:16])
+
+    def fetch(self, concept_class: type, config: dict, name: str, builder: Callable[[], np.ndarray]) -> np.ndarray:
+        """
+        Load the array `name` of the given configuration, or build and store it if it is not cached yet
+        """
+        path = self.get_path(concept_class, config)
+        file = path / (name + '.npy')
+
+        if not file.exists():
+            path.mkdir(parents=True, exist_ok=True)
+
+            array = np.asarray(builder())
+
+            # write to a temporary file first, so that parallel processes never read incomplete arrays
+            tmp_file = path / ('%s.%d.tmp.npy' % (name, os.getpid()))
+            np.save(tmp_file, array)
+            os.replace(tmp_file, file)
+
+        # plain (read-only) array view on the memory-mapped file
+        return np.asarray(np.load(file, mmap_mode='r'))
@@ -1,9 +1,13 @@
-import numpy as np
 import itertools
+import math
+from collections.abc import Sequence
+
+import numpy as np
 
 from actions import Actions
 from random_ng import rand_ng
-from .concept_base import ConceptBase, ConceptItemBase
+from .concept_base import ConceptBase, smallest_int_dtype
+from .concept_cache import ConceptCache
 
 
 # problem: alphabetic arithmetic
@@ -24,7 +28,10 @@ class LetterAddition(ConceptBase):
         'continuous': 0.12,
     }
 
-    def __init__(self, problem_len: int, number_range: list = None):
+    def __init__(self, problem_len: int, number_range: list = None, cache: ConceptCache = None,
+                 equation_length: int = 2):
+        self.cache = cache
+
         elements = np.zeros(problem_len)
         start = ord('A')
 
@@ -37,25 +44,38 @@ class LetterAddition(ConceptBase):
         self.assign_numbers(elements, problem_len, start)
 
         self.item_values = elements
-        self.equation_length = 2
+        self.equation_length = equation_length
 
-        all_number_combinations = list(itertools.permutations(self.numbers, problem_len))
-        self.all_concepts = np.array(all_number_combinations)
+        # implicit space of all permutations, rows are only generated on demand
+        self.all_concepts = PermutationSpace(self.numbers, problem_len)
+        self.prior = self.fetch_table('prior', self.calc_uniform_prior)
 
         self.letter_combs = list(itertools.combinations(range(problem_len), self.equation_length))
 
-        self.possible_values = list(set([x[0] + x[1] for x in itertools.combinations(self.numbers, 2)]))
-
-        self.concept_val_cache = {}
+        self.possible_values = list(set([sum(x) for x in itertools.combinations(self.numbers,
+                                                                                self.equation_length)]))
 
-        self.true_concept_pos = -1
-        for i in range(len(self.all_concepts)):
-            if np.all(self.all_concepts[i] == self.item_values):
-                self.true_concept_pos = i
-                break
+        self.true_concept_pos = self.all_concepts.rank(self.item_values)
 
         super().__init__()
 
+    def calc_action_values(self) -> np.ndarray:
+        """
+        The value of an equation is the sum of the values of its letters, so the table is built with one gather and
+        sum over all equations per block of hypotheses, keeping the peak memory bounded by the chunk size
+        """
+        equations = np.array(self.letter_combs)
+
+        sorted_numbers = np.sort(self.numbers)
+        dtype = smallest_int_dtype(np.sum(sorted_numbers[:self.equation_length]),
+                                   np.sum(sorted_numbers[-self.equation_length:]))
+
+        values = np.empty((len(equations), len(self.all_concepts)), dtype=dtype)
+        for start, hypotheses in self.all_concepts.chunks():
+            values[:, start:start + len(hypotheses)] = np.sum(hypotheses[:, equations], axis=2).T
+
+        return values
+
     def assign_numbers(self, elements, problem_len, start):
         assign_numbers = self.numbers.copy()
         for i in range(problem_len):
@@ -113,20 +133,12 @@ class LetterAddition(ConceptBase):
         return " + ".join(letters) + " = " + right_side
 
     def evaluate_concept(self, result, concept=None, idx=None):
+        if idx is not None:
+            return int(self.action_values[self.action_index[result], idx])
         if concept is None:
             return int(self.evaluate_equation(result))
-        if idx is None:
-            return int(self.evaluate_equation(result, concept))
-
-        if self.concept_val_cache.get(result, None) is None:
-            self.concept_val_cache[result] = np.zeros(len(self.all_concepts))
-
-        concept_val = self.concept_val_cache[result][idx]
-        if concept_val == 0:
-            concept_val = self.evaluate_equation(result, concept)
-            self.concept_val_cache[result][idx] = int(concept_val)
 
-        return concept_val
+        return int(self.evaluate_equation(result, concept))
 
     def assess(self, learner) -> (bool, float):
         guesses = []
@@ -167,8 +179,118 @@ class LetterAddition(ConceptBase):
 
         return response
 
-    def get_default_prior(self) -> np.ndarray:
+    def calc_uniform_prior(self) -> np.ndarray:
         prior_distribution = np.ones(len(self.get_concept_space()))
         prior_distribution /= np.sum(prior_distribution)
 
         return prior_distribution
+
+    def get_default_prior(self) -> np.ndarray:
+        return self.prior
+
+    def get_cache_config(self) -> dict:
+        return {
+            'problem_len': len(self.letters),
+            'number_range': [int(number) for number in self.numbers],
+            'equation_length': self.equation_length
+        }
+
+
+class PermutationSpace(Sequence):
+    """
+    Implicit hypothesis space of all k-permutations of the given numbers, in the order of itertools.permutations.
+
+    Hypotheses are never stored; a row is unranked from its index in O(k) and the rank of a permutation is computed
+    in O(k). Multiple rows are unranked vectorized, so the space can be processed in chunks of bounded size.
+    """
+    CHUNK_SIZE = 2**16
+
+    def __init__(self, numbers: list, length: int):
+        self.numbers = np.array(numbers)
+        self.length = length
+
+        self.positions = {number: pos for pos, number in enumerate(self.numbers.tolist())}
+
+        # number of permutations for the remaining places, i.e. the weight of each place in the rank
+        n = len(self.numbers)
+        self.place_values = [math.perm(n - place - 1, length - place - 1) for place in range(length)]
+        self.size = math.perm(n, length)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.unrank(np.arange(*idx.indices(len(self))))
+
+        if isinstance(idx, (int, np.integer)):
+            return self.unrank_single(int(idx))
+
+        idx = np.asarray(idx)
+        if idx.dtype == bool:
+            idx = np.flatnonzero(idx)
+
+        return self.unrank(idx)
+
+    def __iter__(self):
+        for _, rows in self.chunks():
+            yield from rows
+
+    def __array__(self, dtype=None, copy=None):
+        return self[:].astype(dtype, copy=False) if dtype is not None else self[:]
+
+    def chunks(self, chunk_size: int = None):
+        """
+        Generate all hypotheses as blocks of rows, yields the index of the first row of each block and the rows
+        """
+        if chunk_size is None:
+            chunk_size = self.CHUNK_SIZE
+
+        for start in range(0, len(self), chunk_size):
+            yield start, self.unrank(np.arange(start, min(start + chunk_size, len(self))))
+
+    def rank(self, permutation) -> int:
+        unused = (1 << len(self.numbers)) - 1
+        rank = 0
+
+        for place_value, number in zip(self.place_values, permutation):
+            pos = self.positions.get(number)
+            if pos is None or not unused >> pos & 1:
+                raise ValueError("%s is not a permutation of %s" % (permutation, self.numbers))
+
+            # digit: number of still unused numbers before the current one
+            rank += bin(unused & ((1 << pos) - 1)).count('1') * place_value
+            unused &= ~(1 << pos)
+
+        return rank
+
+    def unrank_single(self, idx: int) -> np.ndarray:
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("permutation index out of range")
+
+        available = self.numbers.tolist()
+        row = []
+        for place_value in self.place_values:
+            row.append(available.pop(idx // place_value % len(available)))
+
+        return np.array(row, dtype=self.numbers.dtype)
+
+    def unrank(self, indices: np.ndarray) -> np.ndarray:
+        indices = np.asarray(indices, dtype=np.int64)
+
+        rows = np.empty((len(indices), self.length), dtype=self.numbers.dtype)
+        available = np.ones((len(indices), len(self.numbers)), dtype=bool)
+        all_rows = np.arange(len(indices))
+
+        for place, place_value in enumerate(self.place_values):
+            digits = indices // place_value % (len(self.numbers) - place)
+
+            # position of the digit-th still available number
+            positions = np.argmax(np.cumsum(available, axis=1) > digits[:, None], axis=1)
+            available[all_rows, positions] = False
+
+            rows[:, place] = self.numbers[positions]
+
+        return rows
@@ -1,9 +1,12 @@
 import math
+from collections.abc import Sequence
+from typing import List
 
 import numpy as np
 
 from actions import ACTION_COSTS_SAMPLE, Actions
 from concepts.concept_base import ConceptBase, ActionResult, ConceptItemBase
+from concepts.concept_cache import ConceptCache
 from random_ng import rand_ng
 
 
@@ -24,8 +27,16 @@ class NumberGame(ConceptBase):
         'continuous': 0.21,
     }
 
-    def __init__(self, target_concept='mul7', space_mode='default'):
+    def __init__(self, target_concept='mul7', space_mode='default', cache: ConceptCache = None, dedup: bool = False):
+        """
+        :param target_concept: one of 'mul7', '64-83', 'mul4-1' or any NumberGameConcept
+        :param dedup: merge hypotheses with identical members into one, summing up their priors
+        """
+        self.cache = cache
+
         self.range = range(1, 101)
+        self.space_mode = space_mode
+        self.dedup = dedup
 
         # self.prior_lambda = 2/3  # lambda from some other paper
         if space_mode == 'orig':
@@ -38,7 +49,9 @@ class NumberGame(ConceptBase):
 
         self.concept_space, self.prior = self.generate_plausible_concepts(space_mode)
 
-        if target_concept == 'mul4-1':
+        if isinstance(target_concept, NumberGameConcept):
+            self.cur_concept = target_concept
+        elif target_concept == 'mul4-1':
             self.cur_concept = NumberGameConcept(multiples=4, multiples_mod=-1)
         elif target_concept == '64-83':
             self.cur_concept = NumberGameConcept(interval_start=64, interval_end=83)
@@ -52,81 +65,143 @@ class NumberGame(ConceptBase):
         super().__init__()
 
     def find_true_concept_idx(self):
-        for idx, concept in enumerate(self.concept_space):
-            if concept == self.cur_concept:
-                return idx
-
-        return -1
+        try:
+            return self.concept_space.index(self.cur_concept)
+        except ValueError:
+            return -1
 
     def generate_plausible_concepts(self, space_mode='default'):
-        math_concepts, range_concepts, mod_math_concepts = [], [], []
-        range_priors = []
+        """
+        Build the hypothesis space as a dense (concepts x numbers) membership matrix, family by family, instead of
+        evaluating every concept object separately. Concept objects are only created lazily when accessed.
+        """
+        numbers = np.arange(self.range.start, self.range.stop)
 
-        math_concepts.append(NumberGameConcept(odd=True))
-        math_concepts.append(NumberGameConcept(even=True))
-        math_concepts.append(NumberGameConcept(square=True))
-        math_concepts.append(NumberGameConcept(cube=True))
-        math_concepts.append(NumberGameConcept(primes=True))
+        math_specs = [dict(odd=True), dict(even=True), dict(square=True), dict(cube=True), dict(primes=True)]
 
+        # multiples (with or without offset) are fully described by a modulus and a remainder
+        math_moduli, mod_math_specs, mod_math_moduli, mod_math_remainders = [], [], [], []
         for i in range(3, 51):
             # multiples of 3-12 are three times present in the orig concept space
             # bigger multiples "only" twice
             if i <= 12:
-                math_concepts.append(NumberGameConcept(multiples=i))
-                if space_mode == 'orig':
-                    mod_math_concepts.append(NumberGameConcept(multiples=i))
-                    mod_math_concepts.append(NumberGameConcept(multiples=i))
+                math_specs.append(dict(multiples=i))
+                math_moduli.append(i)
+                duplicates = 2 if space_mode == 'orig' else 0
             else:
-                mod_math_concepts.append(NumberGameConcept(multiples=i))
-                if space_mode == 'orig':
-                    mod_math_concepts.append(NumberGameConcept(multiples=i))
+                duplicates = 2 if space_mode == 'orig' else 1
+
+            mod_math_specs += [dict(multiples=i)] * duplicates
+            mod_math_moduli += [i] * duplicates
+            mod_math_remainders += [0] * duplicates
 
             for mod in range(1, i):
-                mod_math_concepts.append(NumberGameConcept(multiples=i, multiples_mod=-mod))
+                mod_math_specs.append(dict(multiples=i, multiples_mod=-mod))
+                mod_math_moduli.append(i)
+                mod_math_remainders.append(i - mod)
+
+        powers = np.arange(2, 11)
+        for i in powers.tolist():
+            math_specs += [dict(powers=i), dict(powers=i, powers_zero=True)]
+
+        endings = np.arange(1, 10)
+        math_specs += [dict(ending=i) for i in endings.tolist()]
+
+        # all intervals [a, b] with a <= b, ordered by start and then end
+        starts, ends = np.triu_indices(len(numbers))
+        starts, ends = numbers[starts], numbers[ends]
+        range_specs = [dict(interval_start=a, interval_end=b) for a, b in zip(starts.tolist(), ends.tolist())]
+
+        def build_membership():
+            math_rows = [
+                numbers % 2 == 1,
+                numbers % 2 == 0,
+                np.isin(numbers, np.arange(1, 11) ** 2),
+                np.isin(numbers, np.arange(1, 5) ** 3),
+                np.isin(numbers, NumberGameConcept.prime_numbers),
+            ]
+            math_rows += list(numbers % np.array(math_moduli)[:, None] == 0)
+
+            for i in powers:
+                exponents = i ** np.arange(0, 8)
+                math_rows += [np.isin(numbers, exponents[1:]), np.isin(numbers, exponents)]
+
+            math_rows += list(numbers % 10 == endings[:, None])
+
+            mod_math_rows = numbers % np.array(mod_math_moduli)[:, None] == np.array(mod_math_remainders)[:, None]
+            range_rows = (starts[:, None] <= numbers) & (numbers <= ends[:, None])
+
+            return np.concatenate([np.array(math_rows), mod_math_rows, range_rows])
+
+        def build_prior():
+            range_sizes = ends - starts + 1
+            range_priors = range_sizes / self.erlang_sigma**2 * np.exp(-range_sizes / self.erlang_sigma)
+
+            math_count = len(math_specs)
+            range_count = len(range_specs)
+            mod_math_count = len(mod_math_specs)
 
-        for i in range(2, 11):
-            math_concepts.append(NumberGameConcept(powers=i))
-            math_concepts.append(NumberGameConcept(powers=i, powers_zero=True))
+            math_priors = [self.prior_lambda / 2 / math_count] * math_count
 
-        for i in range(1, 10):
-            math_concepts.append(NumberGameConcept(ending=i))
+            # range_prior_share = (1-self.prior_lambda) * range_count / (range_count+mod_math_count)
+            range_prior_share = (1-self.prior_lambda)
+            # mod_math_prior_share = (1-self.prior_lambda) * mod_math_count / (range_count+mod_math_count)
 
-        for a in range(1, 101):
-            for b in range(a, 101):
-                range_concepts.append(NumberGameConcept(interval_start=a, interval_end=b))
-                range_size = (b - a + 1)
-                range_priors.append(range_size / self.erlang_sigma**2 * math.exp(-range_size/self.erlang_sigma))
+            range_priors /= np.sum(range_priors)
 
-        math_count = len(math_concepts)
-        range_count = len(range_concepts)
-        mod_math_count = len(mod_math_concepts)
+            range_priors = range_priors * range_prior_share
+            mod_math_priors = [self.prior_lambda / 2 / mod_math_count] * mod_math_count
+            # [mod_math_prior_share / mod_math_count] * mod_math_count
 
-        math_priors = [self.prior_lambda / 2 / math_count] * math_count
+            # print("Math concepts: {:d}, mod math {:d}, range concepts: {:d}".format(
+            #     math_count, mod_math_count, range_count
+            # ))
 
-        # range_prior_share = (1-self.prior_lambda) * range_count / (range_count+mod_math_count)
-        range_prior_share = (1-self.prior_lambda)
-        # mod_math_prior_share = (1-self.prior_lambda) * mod_math_count / (range_count+mod_math_count)
+            return np.concatenate([math_priors, mod_math_priors, range_priors])
 
-        range_priors = np.array(range_priors)
-        range_priors /= np.sum(range_priors)
+        specs = math_specs + mod_math_specs + range_specs
 
-        range_priors = np.array(range_priors) * range_prior_share
-        mod_math_priors = [self.prior_lambda / 2 / mod_math_count] * mod_math_count
-        # [mod_math_prior_share / mod_math_count] * mod_math_count
+        if not self.dedup:
+            concepts = NumberGameConceptSpace(specs, self.fetch_table('membership', build_membership))
+            priors = self.fetch_table('prior', build_prior)
+            # priors /= np.sum(priors)
 
-        concepts = math_concepts + mod_math_concepts + range_concepts
-        priors = np.concatenate([math_priors, mod_math_priors, range_priors])
-        # priors /= np.sum(priors)
+            return concepts, priors
 
-        # print("Math concepts: {:d}, mod math {:d}, range concepts: {:d}".format(
-        #     math_count, mod_math_count, range_count
-        # ))
+        def build_canonical_index():
+            # merged hypotheses are numbered in order of their first occurrence
+            _, first_idx, inverse = np.unique(build_membership(), axis=0, return_index=True, return_inverse=True)
+
+            ranks = np.empty_like(first_idx)
+            ranks[np.argsort(first_idx)] = np.arange(len(first_idx))
+
+            return ranks[inverse.ravel()]
+
+        # original hypothesis index -> index of the merged hypothesis
+        canonical_index = self.fetch_table('canonical_index', build_canonical_index)
+        representatives = np.unique(canonical_index, return_index=True)[1]
+
+        membership = self.fetch_table('membership', lambda: build_membership()[representatives])
+        priors = self.fetch_table('prior', lambda: np.bincount(canonical_index, weights=build_prior()))
+
+        concepts = NumberGameConceptSpace([specs[idx] for idx in representatives], membership,
+                                          original_specs=specs, canonical_index=canonical_index)
 
         return concepts, priors
 
+    def get_cache_config(self) -> dict:
+        return {'space_mode': self.space_mode, 'dedup': self.dedup}
+
+    def calc_action_values(self) -> np.ndarray:
+        # the state-action values are simply the columns of the membership matrix
+        return self.concept_space.membership[:, [action - self.range.start for action in self.rl_actions]].T
+
     def get_default_prior(self) -> iter:
         return self.prior
 
+    def get_shared_tables(self) -> List[np.ndarray]:
+        return super().get_shared_tables() + [self.concept_space.membership]
+
     def assess(self, learner) -> (bool, float):
         guesses = []
         correct = True
@@ -172,6 +247,9 @@ class NumberGame(ConceptBase):
     def get_concept_space(self) -> iter:
         return self.concept_space
 
+    def get_uniform_distribution(self) -> np.ndarray:
+        return self.concept_space.uniform_distribution()
+
     def generate_example(self) -> ActionResult:
         if rand_ng.rg.random() > self.inside_prob:
             return rand_ng.rg.choice(self.cur_concept.numbers_inside), True
@@ -185,10 +263,12 @@ class NumberGame(ConceptBase):
         return self.generate_example()
 
     def evaluate_concept(self, action, concept=None, idx=None):
+        if idx is not None:
+            return int(self.action_values[self.action_index[action], idx])
         if concept is None:
-            return int(action in self.cur_concept.numbers_inside)
+            return int(action in self.cur_concept)
 
-        return int(action in concept.numbers_inside)
+        return int(action in concept)
 
     def gen_readable_format(self, result, show_answer=True):
         if show_answer:
@@ -224,9 +304,93 @@ class NumberGame(ConceptBase):
         return [0, 1]
 
 
+class NumberGameConceptSpace(Sequence):
+    """
+    Hypothesis space of the number game, stored as the constructor arguments of each concept plus a dense boolean
+    (concepts x numbers) membership matrix. NumberGameConcept objects are only built (and cached) on access.
+
+    If the space is deduplicated, each entry stands for all original hypotheses with the same members; the original
+    ones are kept in original_specs, with canonical_index mapping them to their merged entry.
+    """
+
+    def __init__(self, specs: List[dict], membership: np.ndarray, original_specs: List[dict] = None,
+                 canonical_index: np.ndarray = None):
+        self.specs = specs
+        self.membership = membership
+
+        self.original_specs = specs if original_specs is None else original_specs
+        self.canonical_index = np.arange(len(specs)) if canonical_index is None else canonical_index
+
+        self.concept_cache = {}
+        self._key_index = None
+
+    @property
+    def key_index(self) -> dict:
+        """
+        Concept key -> index of its first occurrence in the space (also for merged original concepts)
+        """
+        if self._key_index is None:
+            keys = [NumberGameConcept.spec_key(spec) for spec in self.original_specs]
+            self._key_index = {key: int(self.canonical_index[idx]) for idx, key in reversed(list(enumerate(keys)))}
+
+        return self._key_index
+
+    def get_aliases(self, idx) -> List['NumberGameConcept']:
+        """
+        All original concepts represented by the entry at idx
+        """
+        return [NumberGameConcept(**self.original_specs[orig_idx])
+                for orig_idx in np.flatnonzero(self.canonical_index == idx)]
+
+    def uniform_distribution(self) -> np.ndarray:
+        """
+        Uniform distribution over the original hypotheses, i.e. every entry weighted by the number it stands for
+        """
+        return np.bincount(self.canonical_index, minlength=len(self.specs)) / len(self.canonical_index)
+
+    def __len__(self):
+        return len(self.specs)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self[i] for i in range(*idx.indices(len(self)))]
+
+        idx = int(idx)
+        if idx < 0:
+            idx += len(self)
+
+        concept = self.concept_cache.get(idx)
+        if concept is None:
+            concept = NumberGameConcept(**self.specs[idx])
+            self.concept_cache[idx] = concept
+
+        return concept
+
+    def index(self, concept, start=0, stop=None):
+        if start != 0 or stop is not None:
+            return self.specs.index(concept.get_spec(), start, len(self) if stop is None else stop)
+
+        idx = self.key_index.get(concept.key)
+        if idx is None:
+            raise ValueError('{} is not in the concept space'.format(concept))
+
+        return idx
+
+
 class NumberGameConcept(ConceptItemBase):
     prime_numbers = [2, 3, 5, 7, 11, 13, 17, 19, 23, 29, 31, 37, 41, 43, 47, 53, 59, 61, 67, 71, 73, 79, 83, 89, 97]
 
+    SPEC_DEFAULTS = {
+        'odd': False, 'even': False, 'square': False, 'cube': False, 'primes': False, 'multiples': False,
+        'powers': False, 'powers_zero': False, 'ending': False, 'interval_start': False, 'interval_end': False,
+        'multiples_mod': False, 'multiples_start': 0
+    }
+
+    # membership of the numbers 1-100 is stored as bit mask, bit i-1 is set if i is inside
+    __slots__ = tuple(SPEC_DEFAULTS) + ('mask',)
+
+    range = range(1, 101)
+
     def __init__(self, odd=False, even=False, square=False, cube=False, primes=False, multiples=False, powers=False,
                  powers_zero=False,
                  ending=False, interval_start=False, interval_end=False,
@@ -245,14 +409,40 @@ class NumberGameConcept(ConceptItemBase):
         self.odd = odd
         self.ending = ending
 
-        self.range = range(1, 101)
-        self.numbers_inside, self.numbers_outside = [], []
-
+        self.mask = 0
         for i in self.range:
             if self.check(i):
-                self.numbers_inside.append(i)
-            else:
-                self.numbers_outside.append(i)
+                self.mask |= 1 << (i - self.range.start)
+
+    @classmethod
+    def spec_key(cls, spec: dict) -> tuple:
+        return tuple(spec.get(key, default) for key, default in cls.SPEC_DEFAULTS.items())
+
+    @property
+    def key(self) -> tuple:
+        """
+        Canonical, hashable representation of the concept: all constructor arguments in a fixed order
+        """
+        return tuple(getattr(self, key) for key in self.SPEC_DEFAULTS)
+
+    @property
+    def numbers_inside(self) -> List[int]:
+        return [i for i in self.range if i in self]
+
+    @property
+    def numbers_outside(self) -> List[int]:
+        return [i for i in self.range if i not in self]
+
+    def __contains__(self, number) -> bool:
+        offset = int(number) - self.range.start
+        return 0 <= offset < len(self.range) and bool(self.mask >> offset & 1)
+
+    def get_spec(self) -> dict:
+        """
+        Constructor arguments that differ from the defaults, as used in the NumberGameConceptSpace
+        """
+        return {key: getattr(self, key) for key, default in self.SPEC_DEFAULTS.items()
+                if getattr(self, key) != default}
 
     def check(self, number: int) -> any:
         if self.odd:
@@ -318,19 +508,13 @@ class NumberGameConcept(ConceptItemBase):
         return number % 10 == self.ending
 
     def __eq__(self, other):
-        return (self.multiples_mod == other.multiples_mod
-                and self.interval_end == other.interval_end
-                and self.interval_start == other.interval_start
-                and self.powers == other.powers
-                and self.powers_zero == other.powers_zero
-                and self.multiples == other.multiples
-                and self.multiples_start == other.multiples_start
-                and self.primes == other.primes
-                and self.cube == other.cube
-                and self.square == other.square
-                and self.even == other.even
-                and self.odd == other.odd
-                and self.ending == other.ending)
+        if not isinstance(other, NumberGameConcept):
+            return NotImplemented
+
+        return self.key == other.key
+
+    def __hash__(self):
+        return hash(self.key)
 
     def __str__(self):
         if self.odd:
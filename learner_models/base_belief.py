@@ -1,22 +1,25 @@
-from typing import Dict, Any
-
 import numpy as np
 from abc import ABC, abstractmethod
+from typing import Callable, List
 
 from actions import Actions
-from concepts.concept_base import ConceptBase, ActionResult
+from concepts.concept_base import ConceptBase, ActionResult, ActionValues
 
 DEBUG = False
 
 
 class BaseBelief(ABC):
-    state_action_values: Dict[Any, np.ndarray]
+    state_action_values: ActionValues
 
     name = ''
 
-    def __init__(self, belief_state, prior: np.ndarray, concept: ConceptBase, verbose: bool = True):
+    def __init__(self, belief_state, prior: np.ndarray, concept: ConceptBase, verbose: bool = True,
+                 dtype=np.float64):
+        # float precision of the beliefs (and the prior they are updated with)
+        self.dtype = np.dtype(dtype)
+
         self.belief_state = belief_state
-        self.prior = prior
+        self.prior = self.typed_prior(prior, concept, self.dtype)
         self.concept = concept
 
         self.transition_noise = concept.TRANS_NOISE[self.name]
@@ -29,6 +32,9 @@ class BaseBelief(ABC):
 
         self.state_action_values = self.concept.state_action_values
 
+        # saved states of the open checkpoints
+        self.checkpoints = []
+
     @abstractmethod
     def reset(self):
         pass
@@ -46,8 +52,26 @@ class BaseBelief(ABC):
         new_belief = self.belief_update_formula(action_type, result, response)
         new_belief = self.assert_belief_is_valid(action_type, new_belief, response, result)
         # scale to 1
-        new_belief /= np.sum(new_belief)
-        return new_belief
+        return self.normalize(new_belief)
+
+    @staticmethod
+    def normalize(belief: np.ndarray, axis=None) -> np.ndarray:
+        """
+        Scale the belief (or each belief along the axis) to sum 1 in place, in the precision of the belief. The pairwise
+        summation of numpy keeps the error of the sum small even in single precision, and the sum is converted to the
+        belief dtype so that the division does not go through double precision (or upcast the belief).
+        """
+        total = np.sum(belief, axis=axis, keepdims=axis is not None)
+        belief /= total.astype(belief.dtype, copy=False)
+        return belief
+
+    @staticmethod
+    def typed_prior(prior: np.ndarray, concept: ConceptBase, dtype: np.dtype) -> np.ndarray:
+        if prior is concept.get_default_prior():
+            # shared with the other models, converted once by the concept
+            return concept.get_prior(dtype)
+
+        return np.asarray(prior, dtype=dtype)
 
     def assert_belief_is_valid(self, action_type, new_belief, response, result):
         # TODO Note: Additional belief resetting
@@ -66,10 +90,61 @@ class BaseBelief(ABC):
         return new_belief
 
     def belief_update_formula(self, action_type, action: ActionResult, observation):
+        """
+        Bayes filter on all hypotheses at once: b'(s') ~ p(z | s', a) * sum_s p(s' | s, a) b(s)
+        """
+        new_belief = self.transition_prediction_vec(action_type, action, observation)
+        new_belief *= self.observation_likelihood_vec(action_type, action, observation)
+
+        return new_belief
+
+    @abstractmethod
+    def observation_likelihood_vec(self, action_type, action: ActionResult, observation):
+        """
+        Probability of the observation in every (new) state; a scalar if it is the same for all of them
+        """
+        pass
+
+    @abstractmethod
+    def transition_prediction_vec(self, action_type, action: ActionResult, observation) -> np.ndarray:
+        """
+        New array with the probability of reaching every state from the current belief, sum_s p(s' | s, a) b(s)
+        """
+        pass
+
+    @abstractmethod
+    def update_belief_batch(self, action_type, actions: List[ActionResult], observations: list):
+        """
+        Result of update_belief for every pair of action and observation, computed from the current state at once and
+        without changing it
+        """
+        pass
+
+    def concept_prob_evaluator(self, index, checkpoint: int) -> Callable[[Actions, ActionResult, any], float]:
+        """
+        Function giving get_concept_prob(index) after update_belief(action_type, action, observation), for evaluating
+        many updates of the state of the checkpoint. The belief has to be in that state and is returned to it
+        afterwards; models can compute the probability without changing the state at all.
+        """
+        def concept_prob(action_type, action: ActionResult, observation):
+            self.update_belief(action_type, action, observation)
+            prob = self.get_concept_prob(index)
+            self.rollback(checkpoint)
+
+            return prob
+
+        return concept_prob
+
+    def belief_update_formula_loop(self, action_type, action: ActionResult, observation):
+        """
+        Reference implementation of the update with the scalar observation and transition models
+        """
         new_belief = np.zeros_like(self.belief_state)
 
+        concept_vals = self.concept.evaluate_concepts(action[0])
+
         for idx, new_state in enumerate(self.hypotheses):
-            concept_val = self.concept.evaluate_concept(action[0], new_state, idx)
+            concept_val = concept_vals[idx]
 
             p_z = self.observation_model(observation, new_state, action_type, action, concept_val)
             if p_z == 0:
@@ -103,6 +178,56 @@ class BaseBelief(ABC):
     def set_state(self, state):
         pass
 
+    def checkpoint(self) -> int:
+        """
+        Save the current state to return to it with rollback, without copying the whole state where possible.
+        Checkpoints can be nested.
+        """
+        self.checkpoints.append(self.save_checkpoint(len(self.checkpoints)))
+        return len(self.checkpoints) - 1
+
+    def rollback(self, token: int):
+        """
+        Return to the state of the checkpoint, which stays open; later checkpoints are discarded
+        """
+        del self.checkpoints[token + 1:]
+        self.restore_checkpoint(self.checkpoints[token])
+
+    def release(self, token: int):
+        """
+        Discard the checkpoint (and all later ones) without changing the current state
+        """
+        del self.checkpoints[token:]
+
+    def save_checkpoint(self, level: int):
+        return self.get_state()
+
+    def restore_checkpoint(self, saved_state):
+        self.set_state(saved_state)
+
+    @abstractmethod
+    def fingerprint(self) -> int:
+        """
+        Hash of the state for finding equal beliefs (up to floating point noise), e.g. reached by different orders of
+        the same actions
+        """
+        pass
+
+    @staticmethod
+    def array_fingerprint(values: np.ndarray) -> int:
+        """
+        Hash of the values (of at most 1) rounded to a fixed grid
+        """
+        return hash(np.rint(values * 2. ** 40).astype(np.int64).tobytes())
+
+    @abstractmethod
+    def sample_hidden_state(self):
+        """
+        Reduce the belief in place to a single state sampled from it, e.g. as the hidden state of a learner in sampled
+        simulations, which are then updated with their own responses
+        """
+        pass
+
     @abstractmethod
     def get_concept_prob(self, index) -> float:
         pass
@@ -116,7 +241,7 @@ class BaseBelief(ABC):
         return o
 
     def __copy__(self):
-        return BaseBelief(self.belief_state.copy(), self.prior, self.concept, verbose=self.verbose)
+        return BaseBelief(self.belief_state.copy(), self.prior, self.concept, verbose=self.verbose, dtype=self.dtype)
 
 
 class DummyBelief(BaseBelief):
@@ -134,12 +259,28 @@ class DummyBelief(BaseBelief):
     def transition_model(self, new_state, new_idx, action_type, action, concept_val):
         pass
 
+    def observation_likelihood_vec(self, action_type, action, observation):
+        return 1.
+
+    def transition_prediction_vec(self, action_type, action, observation):
+        return np.array(self.belief_state, dtype=self.dtype)
+
+    def update_belief_batch(self, action_type, actions, observations):
+        # the belief is never updated
+        return np.tile(np.array(self.belief_state, dtype=self.dtype), (len(actions), 1))
+
     def get_state(self):
         pass
 
     def set_state(self, state):
         pass
 
+    def fingerprint(self) -> int:
+        return 0
+
+    def sample_hidden_state(self):
+        pass
+
     def get_concept_prob(self, index) -> float:
         pass
 
@@ -1,7 +1,6 @@
-from copy import deepcopy
-
 from learner_models.base_belief import BaseBelief
 from concepts.concept_base import ConceptBase
+from random_ng import rand_ng
 
 import numpy as np
 
@@ -9,42 +8,73 @@ import numpy as np
 class ContinuousModel(BaseBelief):
     name = 'continuous'
 
-    def __init__(self, prior, concept: ConceptBase, particle_num: int = 16, verbose: bool = True):
-        super().__init__([], prior, concept, verbose=verbose)
+    # relative tolerance for particles to count as identical when merging them
+    merge_tolerance = 1e-9
 
-        self.particle_num = particle_num
+    def __init__(self, prior, concept: ConceptBase, particle_num: int = 16, verbose: bool = True,
+                 dtype=np.float64, merge_particles: bool = False, kl_bound: float = None):
+        """
+        :param merge_particles: merge identical particles after every content update, summing up their weights
+        :param kl_bound: adaptive particle budget, keep only as many of the particles (up to particle_num) as needed
+        to bound the KL divergence between the kept and all particle weights; None for always using particle_num
+        """
+        super().__init__([], prior, concept, verbose=verbose, dtype=dtype)
 
-        self.particle_dists = []
-        self.particle_weights = []
+        self.particle_num = particle_num
+        self.merge_particles = merge_particles
+        self.kl_bound = kl_bound
+
+        # particles are the first particle_count rows of a preallocated matrix, with room for splitting all of them;
+        # the weights are always kept in double precision
+        capacity = 2 * max(particle_num, 2)
+        self.particles = np.zeros((capacity, len(self.hypotheses)), dtype=self.dtype)
+        self.weights = np.zeros(capacity)
+        self.particle_count = 0
         self.init_particles()
 
-        self.action_history = []
+        # hypotheses consistent with the content of all actions so far, None while there is none
+        self.history_mask = None
 
         self.particle_depletion_limit = 0.005
 
+        # preallocated copies of the particles per checkpoint level
+        self.checkpoint_buffers = []
+
+        # fixed projections of the particles for their fingerprint
+        positions = np.arange(len(self.hypotheses))
+        self.fingerprint_probes = np.stack([positions / len(self.hypotheses), np.sin(positions)], axis=1)
+
         self.history_calcs = 0
 
+    @property
+    def particle_dists(self) -> np.ndarray:
+        return self.particles[:self.particle_count]
+
+    @property
+    def particle_weights(self) -> np.ndarray:
+        return self.weights[:self.particle_count]
+
     def init_particles(self):
         # init particles
-        # Uniform particle
-        particle1_dist = np.ones(len(self.hypotheses)) / len(self.hypotheses)
-        particle1_weight = 0.5
-        self.particle_dists.append(particle1_dist)
-        self.particle_weights.append(particle1_weight)
+        # Uniform particle (over the original hypotheses of a deduplicated space)
+        self.particles[0] = self.concept.get_uniform_distribution()
+        self.weights[0] = 0.5
+        self.particle_count = 1
 
         # Prior particle
-        particle2_dist = np.copy(self.prior)
-
-        if np.allclose(particle2_dist, particle1_dist):
-            self.particle_weights[0] = 1
+        if np.allclose(self.prior, self.particles[0]):
+            self.weights[0] = 1
             return
 
-        particle2_weight = 0.5
-        self.particle_dists.append(particle2_dist)
-        self.particle_weights.append(particle2_weight)
+        self.particles[1] = self.prior
+        self.weights[1] = 0.5
+        self.particle_count = 2
 
     def update_belief(self, action_type, result, response):
-        self.action_history.append((action_type, result, response))
+        transition_happened = result[1] is not None
+        if transition_happened:
+            # also used when the particles are recreated by the response update
+            self.update_history_mask(result)
 
         if response is not None:
             # update based on response
@@ -52,17 +82,27 @@ class ContinuousModel(BaseBelief):
 
         # since the concepts are modeled as distributions, even for correct feedback actions we can use it to eliminate
         # probability on non-matching concepts
-        transition_happened = result[1] is not None
         if transition_happened:
             # update based on content
             self.update_from_content(result)
 
+    def consistent_mask(self, result) -> np.ndarray:
+        return self.concept.action_values[self.concept.get_action_index(result[0])] == result[1]
+
+    def update_history_mask(self, result):
+        consistent = self.consistent_mask(result)
+
+        # replaced instead of changed in place, so saved states can keep a reference to it
+        if self.history_mask is None:
+            self.history_mask = consistent
+        else:
+            self.history_mask = self.history_mask & consistent
+
     def update_from_content(self, result):
-        concepts_inconsistent = self.state_action_values[result[0]] != result[1]
+        self.create_updated_particles(self.consistent_mask(result))
 
-        new_particle_weights, new_particles = self.create_updated_particles(concepts_inconsistent)
-        self.particle_dists = new_particles
-        self.particle_weights = new_particle_weights
+        if self.merge_particles:
+            self.merge_identical_particles()
 
         self.check_particles_valid()
 
@@ -74,86 +114,504 @@ class ContinuousModel(BaseBelief):
             self.assert_particle_limit()
 
             # re-normalize weights
-            weight_sum = np.sum(self.particle_weights)
-            self.particle_weights = [w / weight_sum for w in self.particle_weights]
+            weights = self.particle_weights
+            weights /= np.sum(weights)
+
+    def create_updated_particles(self, concepts_consistent):
+        """
+        Split every particle into one for not being transitioned and one for the transitioned state, i.e. with
+        probability only on the consistent concepts. The particles are kept alternating: not transitioned,
+        transitioned.
+        """
+        count = self.particle_count
+        particles, weights = self.particles[:2 * count], self.weights[:2 * count]
+
+        # new particles for transitioned states in the second half
+        transitioned = particles[count:]
+        np.multiply(particles[:count], concepts_consistent, out=transitioned)
+        self.normalize(transitioned, axis=1)
+
+        weights[count:] = weights[:count] * (1 - self.transition_noise)
+        weights[:count] *= self.transition_noise
+
+        order = np.arange(2 * count).reshape(2, count).T.ravel()
+        particles[:] = particles[order]
+        weights[:] = weights[order]
+
+        self.particle_count = 2 * count
+
+    def merge_identical_particles(self):
+        """
+        Merge identical particles into the first of them, with their summed weight
+        """
+        representatives = self.identical_particle_representatives(*self.particle_signatures(self.particle_dists))
+
+        keep = np.flatnonzero(representatives == np.arange(self.particle_count))
+        if len(keep) == self.particle_count:
+            return
 
-    def create_updated_particles(self, concepts_inconsistent):
-        new_particles = []
-        new_particle_weights = []
+        merged_weights = np.bincount(representatives, weights=self.particle_weights, minlength=self.particle_count)
+
+        self.particles[:len(keep)] = self.particles[keep]
+        self.weights[:len(keep)] = merged_weights[keep]
+        self.particle_count = len(keep)
+
+    @staticmethod
+    def particle_signatures(dists: np.ndarray):
+        """
+        Packed support masks, norms and mean hypothesis indices of the particles, which are much cheaper to compare
+        than the whole distributions
+        """
+        supports = np.packbits(dists > 0, axis=1)
+        norms = np.einsum('ij,ij->i', dists, dists)
+        means = dists @ np.arange(dists.shape[1], dtype=dists.dtype)
+
+        return supports, norms, means
+
+    def identical_particle_representatives(self, supports: np.ndarray, norms: np.ndarray,
+                                           means: np.ndarray) -> np.ndarray:
+        """
+        Index of the first identical particle for every particle. Particles count as identical with the same support
+        (found by hashing the support masks) and the same norm and mean hypothesis index.
+        """
+        representatives = np.arange(len(norms))
+        support_groups = {}
+        for idx in range(len(norms)):
+            group = support_groups.setdefault(supports[idx].tobytes(), [])
+
+            for other in group:
+                if (abs(norms[idx] - norms[other]) <= self.merge_tolerance * norms[other]
+                        and abs(means[idx] - means[other]) <= self.merge_tolerance * means[other]):
+                    representatives[idx] = other
+                    break
+            else:
+                group.append(idx)
+
+        return representatives
+
+    def particle_budget(self, weights: np.ndarray) -> int:
+        if self.kl_bound is None:
+            return self.particle_num
+
+        return min(self.particle_num, self.kl_particle_count(weights, self.kl_bound))
+
+    def particle_budgets(self, weights: np.ndarray, valid: np.ndarray) -> np.ndarray:
+        """
+        particle_budget for every row of the weights, of the valid particles only
+        """
+        if self.kl_bound is None:
+            return np.full(len(weights), self.particle_num)
+
+        # same steps as kl_particle_count, the invalid particles add zeros at the end
+        sorted_weights = -np.sort(-np.where(valid, weights, 0), axis=1)
+        kept_share = np.cumsum(sorted_weights, axis=1) / np.sum(sorted_weights, axis=1, keepdims=True)
+        counts = np.count_nonzero(kept_share < np.exp(-self.kl_bound) - 1e-12, axis=1) + 1
+
+        return np.minimum(self.particle_num, np.minimum(counts, np.count_nonzero(valid, axis=1)))
+
+    @staticmethod
+    def kl_particle_count(weights: np.ndarray, kl_bound: float) -> int:
+        """
+        Smallest number of the highest weighted particles with KL(kept || all) = -log(kept weight share) <= kl_bound,
+        in the style of KLD sampling
+        """
+        kept_share = np.sort(weights)[::-1].cumsum()
+        kept_share /= weights.sum()
+
+        # (with some tolerance for the rounding of the cumulative sum)
+        count = int(kept_share.searchsorted(np.exp(-kl_bound) - 1e-12)) + 1
+
+        return min(count, len(weights))
 
-        for idx, particle in enumerate(self.particle_dists):
-            particle_weight = self.particle_weights[idx]
+    def assert_particle_limit(self):
+        particle_budget = self.particle_budget(self.particle_weights)
+        if self.particle_count > particle_budget:
+            keep = self.select_top_particles(self.particle_weights, particle_budget)
 
-            # particle for not being transitioned
-            non_transition_particle = np.copy(particle)
-            non_transition_weight = particle_weight * self.transition_noise
+            self.particles[:len(keep)] = self.particles[keep]
+            self.weights[:len(keep)] = self.weights[keep]
+            self.particle_count = len(keep)
 
-            # new particle for transitioned state
-            particle[concepts_inconsistent] = 0
-            particle /= np.sum(particle)
-            transitioned_weight = particle_weight * (1 - self.transition_noise)
+    @staticmethod
+    def select_top_particles(weights: np.ndarray, count: int) -> np.ndarray:
+        """
+        Indices (in order) of the count particles with the highest weights. Of equal weights the first ones are
+        dropped, as when removing the particle with the lowest weight one after another.
+        """
+        keep = np.argsort(weights, kind='stable')[len(weights) - count:]
+        keep.sort()
 
-            # add new particles
-            new_particles.append(non_transition_particle)
-            new_particle_weights.append(non_transition_weight)
-            new_particles.append(particle)
-            new_particle_weights.append(transitioned_weight)
+        return keep
 
-        return new_particle_weights, new_particles
+    @staticmethod
+    def select_top_particles_batch(weights: np.ndarray, valid: np.ndarray, counts: np.ndarray):
+        """
+        select_top_particles for every row of the weights, of its valid particles only
 
-    def assert_particle_limit(self):
-        if len(self.particle_dists) > self.particle_num:
-            while len(self.particle_dists) > self.particle_num:
-                min_idx: int = np.argmin(self.particle_weights)
-                del self.particle_dists[min_idx]
-                del self.particle_weights[min_idx]
+        :return: (rows x max(counts)) indices of the kept particles in order, padded with invalid ones, and the mask of
+        the kept ones
+        """
+        order = np.argsort(np.where(valid, weights, -np.inf), axis=1, kind='stable')
 
-    def update_from_response(self, response, result):
-        concepts_w_val = self.state_action_values[result[0]] == response
+        kept = np.zeros(weights.shape, dtype=bool)
+        np.put_along_axis(kept, order, np.arange(weights.shape[1]) >= weights.shape[1] - counts[:, None], axis=1)
+
+        keep = np.argsort(~kept, axis=1, kind='stable')[:, :np.max(counts)]
+
+        return keep, np.arange(keep.shape[1]) < counts[:, None]
 
-        for idx, particle in enumerate(self.particle_dists):
-            current_weight = self.particle_weights[idx]
+    def update_from_response(self, response, result):
+        concepts_w_val = self.concept.get_consistent_indices(result[0], response)
 
-            # update weight of particle based on likelihood of producing the response
-            p_z = np.sum(particle[concepts_w_val])
-            new_weight = current_weight * ((1 - self.production_noise) * p_z + self.obs_noise_prob)
+        # update weight of particle based on likelihood of producing the response
+        p_z = self.consistent_probs(self.particle_dists, concepts_w_val)
 
-            self.particle_weights[idx] = new_weight
+        weights = self.particle_weights
+        weights *= (1 - self.production_noise) * p_z + self.obs_noise_prob
 
         self.check_particles_valid()
 
+    @staticmethod
+    def consistent_probs(dists: np.ndarray, indices: np.ndarray) -> np.ndarray:
+        """
+        Probability of the hypotheses at the indices in every particle, summed up in the same order as for a single
+        particle: the columns selected by indexing are in Fortran order, whose rows numpy sums up sequentially instead
+        of pairwise, which changes which of the particles with tied weights are dropped
+        """
+        return np.sum(dists.take(indices, axis=1), axis=1)
+
+    def update_belief_batch(self, action_type, actions, observations):
+        """
+        :return: (candidates x particles x hypotheses) particle distributions and (candidates x particles) weights;
+        candidates with fewer particles are padded with zero weight particles
+        """
+        candidate_count = len(actions)
+
+        # particles of every candidate: the current particle they come from, whether it is transitioned and their
+        # weight; only the valid ones are used
+        sources = np.tile(np.arange(self.particle_count), (candidate_count, 1))
+        transitioned = np.zeros(sources.shape, dtype=bool)
+        weights = np.tile(self.particle_weights, (candidate_count, 1))
+        valid = np.ones(sources.shape, dtype=bool)
+        depleted = np.zeros(candidate_count, dtype=bool)
+
+        has_obs = np.array([observation is not None for observation in observations])
+        if np.any(has_obs):
+            # summed up per candidate like in update_from_response, the particles kept depend on the exact weights
+            p_z = np.array([self.consistent_probs(self.particle_dists,
+                                                  self.concept.get_consistent_indices(action[0], observation))
+                            for action, observation in zip(actions, observations) if observation is not None])
+
+            weights[has_obs] *= (1 - self.production_noise) * p_z + self.obs_noise_prob
+            depleted[has_obs] = np.sum(weights[has_obs], axis=1) < self.particle_depletion_limit
+
+            # same steps as check_particles_valid
+            updated = has_obs & ~depleted
+            budgets = np.full(candidate_count, self.particle_count)
+            budgets[updated] = np.minimum(self.particle_budgets(weights[updated], valid[updated]), self.particle_count)
+            if np.any(budgets < self.particle_count):
+                keep, valid = self.select_top_particles_batch(weights, valid, budgets)
+                sources = np.take_along_axis(sources, keep, axis=1)
+                weights = np.take_along_axis(weights, keep, axis=1) * valid
+
+            weights[updated] /= np.sum(weights[updated], axis=1, keepdims=True)
+
+        if actions[0][1] is not None:
+            # particles for not being transitioned and for the transitioned state, alternating as in
+            # create_updated_particles
+            sources = np.repeat(sources, 2, axis=1)
+            transitioned = np.tile([False, True], weights.shape)
+            valid = np.repeat(valid, 2, axis=1)
+            weights = np.stack([weights * self.transition_noise, weights * (1 - self.transition_noise)], axis=2)
+            weights = weights.reshape(candidate_count, -1)
+
+            if self.merge_particles:
+                self.merge_identical_particles_batch(actions, sources, transitioned, weights, valid, ~depleted)
+
+            depleted |= np.sum(weights, axis=1) < self.particle_depletion_limit
+
+            # same particles as in check_particles_valid
+            budgets = np.count_nonzero(valid, axis=1)
+            budgets[~depleted] = np.minimum(self.particle_budgets(weights[~depleted], valid[~depleted]),
+                                            budgets[~depleted])
+            keep, valid = self.select_top_particles_batch(weights, valid, budgets)
+            sources = np.take_along_axis(sources, keep, axis=1)
+            transitioned = np.take_along_axis(transitioned, keep, axis=1)
+            weights = np.take_along_axis(weights, keep, axis=1) * valid
+
+            weights[~depleted] /= np.sum(weights[~depleted], axis=1, keepdims=True)
+
+        # only build the remaining particles
+        dists = self.particle_dists[sources]
+        dists[~valid] = 0
+
+        if np.any(transitioned):
+            values = self.concept.get_action_values([action[0] for action in actions])
+            concepts_consistent = values == np.array([action[1] for action in actions])[:, None]
+
+            candidate_idx, particle_idx = np.nonzero(transitioned & valid)
+            transitioned_dists = dists[candidate_idx, particle_idx] * concepts_consistent[candidate_idx]
+            self.normalize(transitioned_dists, axis=1)
+            dists[candidate_idx, particle_idx] = transitioned_dists
+
+        if np.any(depleted):
+            # particles are recreated from the history, use the regular update for these candidates
+            dists, weights = self.update_candidates_separately(action_type, actions, observations, dists, weights,
+                                                               depleted)
+
+        return dists, weights
+
+    def merge_identical_particles_batch(self, actions, sources, transitioned, weights, valid, candidates):
+        """
+        merge_identical_particles for the split particles of the candidates, changing their weights and valid masks
+        in place
+        """
+        signatures = self.particle_signatures(self.particle_dists)
+
+        for row in np.flatnonzero(candidates):
+            transitioned_signatures = self.particle_signatures(self.transitioned_particles(actions[row]))
+
+            particles = np.flatnonzero(valid[row])
+            row_sources, row_transitioned = sources[row, particles], transitioned[row, particles]
+            row_signatures = [np.where(row_transitioned.reshape((-1,) + (1,) * (split.ndim - 1)),
+                                       split[row_sources], current[row_sources])
+                              for current, split in zip(signatures, transitioned_signatures)]
+
+            representatives = self.identical_particle_representatives(*row_signatures)
+
+            weights[row] = np.bincount(particles[representatives], weights=weights[row, particles],
+                                       minlength=weights.shape[1])
+            valid[row] = False
+            valid[row, particles[representatives == np.arange(len(particles))]] = True
+
+    def concept_prob_evaluator(self, index, checkpoint: int):
+        """
+        Only the weights of the updated particles and their probabilities of the concept are computed. The response
+        likelihoods and the transitioned particles only depend on the item (and response), they are computed once for
+        all candidates, as are the identical particles to merge.
+        """
+        if self.particle_count > self.particle_num:
+            return super().concept_prob_evaluator(index, checkpoint)
+
+        regular_concept_prob = super().concept_prob_evaluator(index, checkpoint)
+
+        dists = self.particle_dists
+        all_particles = np.arange(self.particle_count)
+        signatures = self.particle_signatures(dists) if self.merge_particles else None
+        likelihoods = {}
+        # action -> probability of the concept in the transitioned particles (and their signatures)
+        transitions = {}
+        # (action, particles kept after the response) -> identical split particles to merge
+        merges = {}
+
+        def concept_prob(action_type, action, observation):
+            weights = self.particle_weights
+            particles = all_particles
+            concept_probs = dists[:, index]
+
+            if observation is not None:
+                # same steps as update_from_response
+                p_z = likelihoods.get((action[0], observation))
+                if p_z is None:
+                    p_z = self.consistent_probs(dists, self.concept.get_consistent_indices(action[0], observation))
+                    likelihoods[(action[0], observation)] = p_z
+
+                weights = weights * ((1 - self.production_noise) * p_z + self.obs_noise_prob)
+
+                keep = self.kept_particles(weights)
+                if keep is None:
+                    # particles are recreated from the history
+                    return regular_concept_prob(action_type, action, observation)
+
+                if len(keep) < len(weights):
+                    particles, weights, concept_probs = particles[keep], weights[keep], concept_probs[keep]
+                weights /= np.sum(weights)
+
+            if action[1] is not None:
+                # same steps as create_updated_particles (and merge_identical_particles), for the probability of the
+                # concept only
+                transition = transitions.get(action)
+                if transition is None:
+                    transitioned = self.transitioned_particles(action)
+                    transition = transitions[action] = (
+                        transitioned[:, index].copy(),
+                        self.particle_signatures(transitioned) if self.merge_particles else None)
+
+                split_weights = np.empty(2 * len(weights))
+                split_weights[1::2] = weights * (1 - self.transition_noise)
+                split_weights[::2] = weights * self.transition_noise
+
+                split_probs = np.empty(2 * len(weights), dtype=self.dtype)
+                split_probs[::2] = concept_probs
+                split_probs[1::2] = transition[0][particles]
+
+                if self.merge_particles:
+                    key = (action, particles.tobytes())
+                    merge = merges.get(key)
+                    if merge is None:
+                        merge = merges[key] = self.split_particle_merge(signatures, transition[1], particles)
+
+                    if merge:
+                        split_representatives, merged = merge
+                        split_weights = np.bincount(split_representatives, weights=split_weights,
+                                                    minlength=len(split_weights))[merged]
+                        split_probs = split_probs[merged]
+
+                keep = self.kept_particles(split_weights)
+                if keep is None:
+                    return regular_concept_prob(action_type, action, observation)
+
+                weights, concept_probs = split_weights, split_probs
+                if len(keep) < len(weights):
+                    weights, concept_probs = weights[keep], concept_probs[keep]
+                weights /= np.sum(weights)
+
+            return self.column_dot(weights, concept_probs)
+
+        return concept_prob
+
+    def split_particle_merge(self, signatures, transitioned_signatures, particles: np.ndarray):
+        """
+        Representatives of the particles split by create_updated_particles (alternating the particles and their
+        transitioned ones, with the signatures of all particles) and the indices of the merged particles, or False
+        if there are no identical particles
+        """
+        split_signatures = [np.stack([current[particles], split[particles]], axis=1).reshape((-1,) + current.shape[1:])
+                            for current, split in zip(signatures, transitioned_signatures)]
+        representatives = self.identical_particle_representatives(*split_signatures)
+
+        merged = np.flatnonzero(representatives == np.arange(len(representatives)))
+        if len(merged) == len(representatives):
+            return False
+
+        return representatives, merged
+
+    def transitioned_particles(self, action) -> np.ndarray:
+        """
+        New array with the transitioned particle of every particle, as in create_updated_particles
+        """
+        transitioned = self.particle_dists * self.consistent_mask(action)
+
+        return self.normalize(transitioned, axis=1)
+
+    def kept_particles(self, weights: np.ndarray):
+        """
+        Indices of the particles kept by check_particles_valid with the weights, None if the particles are depleted
+        """
+        if np.sum(weights) < self.particle_depletion_limit:
+            return None
+
+        particle_budget = self.particle_budget(weights)
+        if len(weights) > particle_budget:
+            return self.select_top_particles(weights, particle_budget)
+
+        return np.arange(len(weights))
+
+    @staticmethod
+    def column_dot(weights: np.ndarray, column: np.ndarray) -> float:
+        """
+        weights @ column as for a column of the particle matrix: BLAS sums up strided vectors in a different order
+        than contiguous ones
+        """
+        strided = np.empty((len(column), 2), dtype=column.dtype)
+        strided[:, 0] = column
+
+        return weights @ strided[:, 0]
+
+    def update_candidates_separately(self, action_type, actions, observations, dists, weights, candidates):
+        """
+        Replace the batch results of the candidates by the ones of the regular update, padded to the same number of
+        particles
+        """
+        candidate_count = len(actions)
+
+        models = {}
+        for idx in np.flatnonzero(candidates):
+            models[idx] = self.copy()
+            models[idx].update_belief(action_type, actions[idx], observations[idx])
+
+        particle_count = max([dists.shape[1]] + [len(model.particle_dists) for model in models.values()])
+
+        padded_dists = np.zeros((candidate_count, particle_count, dists.shape[2]), dtype=self.dtype)
+        padded_dists[:, :dists.shape[1]] = dists
+        padded_weights = np.zeros((candidate_count, particle_count))
+        padded_weights[:, :weights.shape[1]] = weights
+
+        for idx, model in models.items():
+            padded_dists[idx] = 0
+            padded_dists[idx, :len(model.particle_dists)] = model.particle_dists
+            padded_weights[idx] = 0
+            padded_weights[idx, :len(model.particle_weights)] = model.particle_weights
+
+        return padded_dists, padded_weights
+
     def recreate_particles(self):
-        self.particle_dists = []
-        self.particle_weights = []
-        particle1_dist = np.copy(self.prior)
-        particle1_weight = 0.5
-        self.particle_dists.append(particle1_dist)
-        self.particle_weights.append(particle1_weight)
+        self.particles[0] = self.prior
+        self.weights[0] = 0.5
 
         # particle 2: consistent with observed data
-        # TODO optimization: keep track of history particle instead of recalculating it
-        particle2_dist = np.copy(self.prior)
-        particle2_weight = 0.5
+        history_particle = self.particles[1]
+        history_particle[:] = self.prior
+        if self.history_mask is not None:
+            history_particle *= self.history_mask
+
+            concept_prob_sum = np.sum(history_particle)
+            if concept_prob_sum == 0:
+                raise Exception("encountered degraded particle from history!")
+
+            history_particle /= concept_prob_sum
+
+        self.weights[1] = 0.5
+        self.particle_count = 2
+
+        self.history_calcs += 1
+
+    def marginal_belief(self) -> np.ndarray:
+        """
+        Probability of every hypothesis, summed over the particles
+        """
+        return (self.particle_weights @ self.particle_dists).astype(self.dtype, copy=False)
+
+    def observation_likelihood_vec(self, action_type, action, observation):
+        """
+        Same observation model as the particle weights use in update_from_response, for the marginal belief
+        """
+        # only responses without the answer are evidence, the answer of feedback is given afterwards
+        if observation is None or action[1] is not None:
+            return 1.
+
+        likelihood = np.full(len(self.hypotheses), self.obs_noise_prob, dtype=self.dtype)
+        likelihood[self.concept.get_consistent_indices(action[0], observation)] += 1 - self.production_noise
+
+        return likelihood
+
+    def transition_prediction_vec(self, action_type, action, observation):
+        """
+        Marginal belief of the particles after create_updated_particles (without limiting their number)
+        """
+        if action[1] is None:
+            return self.marginal_belief()
 
-        for action_type, result, response in self.action_history:
-            # update according to observed data
-            particle2_dist = self.transition_model(particle2_dist, None, action_type, result, None)
+        transitioned = np.zeros_like(self.particle_dists)
+        concepts_consistent = self.concept.get_consistent_indices(action[0], action[1])
+        transitioned[:, concepts_consistent] = self.particle_dists[:, concepts_consistent]
+        self.normalize(transitioned, axis=1)
 
-        self.particle_dists.append(particle2_dist)
-        self.particle_weights.append(particle2_weight)
+        predicted = self.particle_weights @ (self.transition_noise * self.particle_dists
+                                             + (1 - self.transition_noise) * transitioned)
 
-        self.history_calcs += len(self.action_history)
+        return predicted.astype(self.dtype, copy=False)
 
     def observation_model(self, observation, new_state, action_type, action, concept_val):
-        concepts_w_val = self.state_action_values[action[0]] == observation
+        concepts_w_val = self.concept.get_consistent_indices(action[0], observation)
 
         p_z = np.sum(new_state[concepts_w_val])
 
         return p_z
 
     def transition_model(self, new_state, new_idx, action_type, action, concept_val):
-        concepts_inconsistent = self.state_action_values[action[0]] != action[1]
-        new_state[concepts_inconsistent] = 0
+        concepts_consistent = self.concept.get_consistent_indices(action[0], action[1])
+        new_state = self.eliminate_inconsistent(new_state, concepts_consistent)
 
         concept_prob_sum = np.sum(new_state)
         if concept_prob_sum == 0:
@@ -163,46 +621,84 @@ class ContinuousModel(BaseBelief):
 
         return new_state
 
-    def get_concept_prob(self, index):
-        prob = 0
+    @staticmethod
+    def eliminate_inconsistent(particle, concepts_consistent):
+        """
+        Copy of the particle with all probability outside of the consistent concepts removed
+        """
+        new_particle = np.zeros_like(particle)
+        new_particle[concepts_consistent] = particle[concepts_consistent]
+
+        return new_particle
 
-        for idx, particle in enumerate(self.particle_dists):
-            prob += self.particle_weights[idx] * particle[index]
+    def sample_hidden_state(self):
+        """
+        Single particle sampled by the particle weights
+        """
+        weights = self.particle_weights
+        particle = rand_ng.rg.choice(self.particle_count, p=weights / np.sum(weights))
 
-        return prob
+        self.particles[0] = self.particles[particle]
+        self.weights[0] = 1
+        self.particle_count = 1
+
+    def get_concept_prob(self, index):
+        return self.particle_weights @ self.particle_dists[:, index]
 
     def get_observation_prob(self, action, observation):
-        concepts_w_obs = self.state_action_values[action[0]] == observation
+        concepts_w_obs = self.concept.get_consistent_indices(action[0], observation)
+
+        # TODO Note: equation clarification
+        consistent_prob = self.consistent_probs(self.particle_dists, concepts_w_obs)
+        response_prob_from_consistent = (1 - self.production_noise) * consistent_prob
+        response_prob_from_inconsistent = self.obs_noise_prob
 
-        prob = 0
-        for idx, particle in enumerate(self.particle_dists):
-            # TODO Note: equation clarification
-            consistent_prob = np.sum(particle[concepts_w_obs])
-            response_prob_from_consistent = (1 - self.production_noise) * consistent_prob
-            response_prob_from_inconsistent = self.obs_noise_prob
+        return self.particle_weights @ (response_prob_from_consistent + response_prob_from_inconsistent)
 
-            prob += self.particle_weights[idx] * (response_prob_from_consistent + response_prob_from_inconsistent)
+    def fingerprint(self) -> int:
+        """
+        Hash of the particle weights and two projections of every particle, and of the history mask
+        """
+        signature = np.concatenate([self.particle_weights, (self.particle_dists @ self.fingerprint_probes).ravel()])
+        history = None if self.history_mask is None else np.packbits(self.history_mask).tobytes()
 
-        return prob
+        return hash((self.array_fingerprint(signature), history))
 
     def get_state(self):
-        return deepcopy(self.particle_dists), self.particle_weights.copy(), self.action_history.copy()
+        return self.particle_dists.copy(), self.particle_weights.copy(), self.history_mask
 
     def set_state(self, state):
-        self.particle_dists = deepcopy(state[0])
-        self.particle_weights = state[1].copy()
-        self.action_history = state[2].copy()
+        self.particle_count = len(state[1])
+        self.particles[:self.particle_count] = state[0]
+        self.weights[:self.particle_count] = state[1]
+        self.history_mask = state[2]
+
+    def save_checkpoint(self, level):
+        if level == len(self.checkpoint_buffers):
+            self.checkpoint_buffers.append((np.empty_like(self.particles), np.empty_like(self.weights)))
+
+        particles, weights = self.checkpoint_buffers[level]
+        particles[:self.particle_count] = self.particle_dists
+        weights[:self.particle_count] = self.particle_weights
+
+        return level, self.particle_count, self.history_mask
+
+    def restore_checkpoint(self, saved_state):
+        level, self.particle_count, self.history_mask = saved_state
+
+        particles, weights = self.checkpoint_buffers[level]
+        self.particles[:self.particle_count] = particles[:self.particle_count]
+        self.weights[:self.particle_count] = weights[:self.particle_count]
 
     def reset(self):
         # super().reset()
-        self.particle_dists = []
-        self.particle_weights = []
         self.init_particles()
 
-        self.action_history = []
+        self.history_mask = None
 
     def __copy__(self):
-        new_model = ContinuousModel(self.prior, self.concept, particle_num=self.particle_num, verbose=self.verbose)
-        new_model.set_state((self.particle_dists, self.particle_weights, self.action_history))
+        new_model = ContinuousModel(self.prior, self.concept, particle_num=self.particle_num, verbose=self.verbose,
+                                    dtype=self.dtype, merge_particles=self.merge_particles, kl_bound=self.kl_bound)
+        new_model.set_state((self.particle_dists, self.particle_weights, self.history_mask))
 
         return new_model
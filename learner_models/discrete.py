@@ -1,4 +1,4 @@
-from collections import deque
+from typing import List, NamedTuple, Tuple
 
 from concepts.concept_base import ConceptBase, ActionResult
 from learner_models.memoryless import MemorylessModel
@@ -10,54 +10,153 @@ import numpy as np
 IGNORE_QUIZ_MEMORY = True
 
 
+class MemoryState(NamedTuple):
+    items: np.ndarray
+    masks: tuple
+    length: int
+    position: int
+    mask: np.ndarray
+
+
 class DiscreteMemoryModel(MemorylessModel):
     name = 'discrete'
 
-    def __init__(self, belief_state, prior, concept: ConceptBase, memory_size: int, verbose: bool = True):
-        super().__init__(belief_state, prior, concept, verbose=verbose)
+    def __init__(self, belief_state, prior, concept: ConceptBase, memory_size: int, verbose: bool = True,
+                 sparse_limit: float = None, dtype=np.float64):
+        super().__init__(belief_state, prior, concept, verbose=verbose, sparse_limit=sparse_limit, dtype=dtype)
 
         # TODO check if still happens: devolves into asking only quizzes at some point?
         self.memory_size = memory_size
 
-        # type: deque[ActionResult]
-        self.memory = deque(maxlen=memory_size)
+        self.reset_memory()
+
+    def reset_memory(self):
+        # ring buffer of the memorized actions as (action type, action index, result)
+        self.memory_items = np.zeros((self.memory_size, 3), dtype=int)
+        self.memory_length = 0
+        self.memory_position = 0
+
+        # per memory slot the hypotheses consistent with its action (None: no restriction), and all of them combined
+        self.memory_masks = [None] * self.memory_size
+        self.memory_mask = None
+
+    def memory_slots(self) -> List[int]:
+        """
+        Ring buffer slots of the memorized actions, oldest first
+        """
+        first = (self.memory_position - self.memory_length) % max(self.memory_size, 1)
+        return [(first + i) % self.memory_size for i in range(self.memory_length)]
+
+    @property
+    def memory(self) -> List[Tuple[Actions, ActionResult]]:
+        """
+        Memorized actions, oldest first
+        """
+        slots = self.memory_slots()
+
+        return [(Actions(self.memory_items[slot, 0]), (self.concept.rl_actions[self.memory_items[slot, 1]],
+                                                      None if self.memory_masks[slot] is None
+                                                      else int(self.memory_items[slot, 2])))
+                for slot in slots]
 
     def reset(self):
         super().reset()
-        self.memory = deque(maxlen=self.memory_size)
+        self.reset_memory()
 
     def see_action(self, action_type, action):
         if IGNORE_QUIZ_MEMORY and action_type == Actions.QUIZ:
             return
 
-        self.memory.append((action_type, action))
+        if self.memory_size == 0:
+            return
+
+        slot = self.memory_position
+        action_idx = self.concept.get_action_index(action[0])
+
+        if action_type == Actions.QUIZ:
+            # no answer given, does not restrict the states
+            self.memory_items[slot] = (action_type.value, action_idx, 0)
+            self.memory_masks[slot] = None
+        else:
+            self.memory_items[slot] = (action_type.value, action_idx, action[1])
+            self.memory_masks[slot] = self.concept.action_values[action_idx] == action[1]
+
+        self.memory_position = (slot + 1) % self.memory_size
+        self.memory_length = min(self.memory_length + 1, self.memory_size)
+
+        masks = [mask for mask in self.memory_masks if mask is not None]
+        self.memory_mask = np.logical_and.reduce(masks) if len(masks) > 0 else None
+
+    def get_memory_state(self) -> MemoryState:
+        # the masks are never changed in place, so they can be shared
+        return MemoryState(self.memory_items.copy(), tuple(self.memory_masks), self.memory_length,
+                           self.memory_position, self.memory_mask)
+
+    def set_memory_state(self, state: MemoryState):
+        self.memory_items = state.items.copy()
+        self.memory_masks = list(state.masks)
+        self.memory_length = state.length
+        self.memory_position = state.position
+        self.memory_mask = state.mask
+
+    def fingerprint(self) -> int:
+        # only the memorized item and result affect later transitions, but their order matters for which one is
+        # forgotten next
+        memory = tuple((int(self.memory_items[slot, 1]), None if self.memory_masks[slot] is None
+                        else int(self.memory_items[slot, 2])) for slot in self.memory_slots())
+
+        return hash((super().fingerprint(), memory))
 
     def get_state(self):
-        return self.belief_state.copy(), self.memory.copy()
+        return self.get_belief_snapshot(), self.get_memory_state()
 
     def set_state(self, state):
-        self.belief_state = state[0].copy()
-        self.memory = state[1].copy()
+        self.set_belief_snapshot(state[0])
+        self.set_memory_state(state[1])
+
+    def save_checkpoint(self, level):
+        return super().save_checkpoint(level), self.get_memory_state()
+
+    def restore_checkpoint(self, saved_state):
+        super().restore_checkpoint(saved_state[0])
+        self.set_memory_state(saved_state[1])
 
     def __copy__(self):
         model = DiscreteMemoryModel(self.belief_state.copy(), self.prior, self.concept, memory_size=self.memory_size,
-                                    verbose=self.verbose)
-        model.memory = self.memory.copy()
+                                    verbose=self.verbose, sparse_limit=self.sparse_limit, dtype=self.dtype)
+        model.set_memory_state(self.get_memory_state())
 
         return model
 
     def find_consistent_states_for_transition(self, action):
-        # state might have changed
         consistent_states = self.state_action_values[action[0]] == action[1]
 
-        if len(self.memory) > 0:
-            const_indices = np.flatnonzero(consistent_states)
-            for idx in const_indices:
-                # check if consistent with memory
-                consistent_states[idx] = self.matches_memory(self.hypotheses[idx], idx)
+        if self.memory_mask is not None:
+            # check if consistent with memory
+            consistent_states &= self.memory_mask
 
         return consistent_states
 
+    def find_consistent_indices_for_transition(self, action):
+        # state might have changed
+        const_indices = self.concept.get_consistent_indices(action[0], action[1])
+
+        if self.memory_mask is not None:
+            # check if consistent with memory
+            const_indices = const_indices[self.matches_memory_batch(const_indices)]
+
+        return const_indices
+
+    def get_transition_memory_mask(self):
+        return self.memory_mask
+
+    def get_consistent_prior_sum(self, action, consistent_states):
+        if self.memory_mask is not None:
+            # states are further restricted by the memory, precomputed sums do not apply
+            return np.sum(self.prior[consistent_states])
+
+        return super().get_consistent_prior_sum(action, consistent_states)
+
     # Model for explicit Bayesian formula
     def transition_model(self, new_state, new_idx, action_type, action, concept_val):
         """
@@ -73,7 +172,7 @@ class DiscreteMemoryModel(MemorylessModel):
 
         # only allow transition if memory matches new state
         # TODO verify
-        if concept_val == action[1] and self.matches_memory(new_state):
+        if concept_val == action[1] and self.matches_memory(new_state, new_idx):
             p_s = self.calculate_ps(action, new_idx)
 
         return p_s
@@ -89,3 +188,12 @@ class DiscreteMemoryModel(MemorylessModel):
                 break
 
         return matches
+
+    def matches_memory_batch(self, indices: np.ndarray) -> np.ndarray:
+        """
+        matches_memory for the states at the indices, from the memory mask
+        """
+        if self.memory_mask is None:
+            return np.ones(len(indices), dtype=bool)
+
+        return self.memory_mask[indices]
@@ -1,75 +1,356 @@
+from typing import NamedTuple
+
 from learner_models.base_belief import BaseBelief
 from concepts.concept_base import ConceptBase
 from actions import Actions
+from random_ng import rand_ng
 
 import numpy as np
 
 
+class SparseBelief(NamedTuple):
+    """
+    Belief snapshot of the active support only: indices of the hypotheses with non-zero probability and their values
+    """
+    indices: np.ndarray
+    values: np.ndarray
+
+
 class MemorylessModel(BaseBelief):
     name = 'memoryless'
 
-    def __init__(self, belief_state, prior, concept: ConceptBase, verbose: bool = True):
-        super().__init__(belief_state, prior, concept, verbose=verbose)
+    def __init__(self, belief_state, prior, concept: ConceptBase, verbose: bool = True, sparse_limit: float = None,
+                 dtype=np.float64):
+        super().__init__(belief_state, prior, concept, verbose=verbose, dtype=dtype)
+
+        self.belief_state_orig = np.array(belief_state, dtype=self.dtype)
+
+        # preallocated arrays of the in-place update kernels: the belief alternates between the two belief buffers,
+        # the other one receives the next update
+        self.belief_buffers = (np.empty(len(prior), dtype=self.dtype), np.empty(len(prior), dtype=self.dtype))
+        self.mask_buffer = np.empty(len(prior), dtype=bool)
+        self.inverse_mask_buffer = np.empty(len(prior), dtype=bool)
+        self.scratch_buffer = np.empty(len(prior), dtype=self.dtype)
+        self.candidate_buffer = np.empty(len(prior), dtype=self.dtype)
+
+        # preallocated copies of the dense belief per checkpoint level
+        self.checkpoint_buffers = []
+
+        self.belief_state = self.belief_buffers[0]
+        np.copyto(self.belief_state, belief_state)
 
-        self.belief_state_orig = belief_state.copy()
+        # uniform prior - transition probabilities to all consistent states are the same
+        self.uniform_prior = np.max(prior) == np.min(prior)
 
-    def belief_update_formula(self, action_type, action, observation):
+        # optional sparse backend: while at most sparse_limit * |hypotheses| states have non-zero probability, updates
+        # only touch the active support; None means the belief is treated as dense
+        self.sparse_limit = sparse_limit
+        self.support = None
+        if sparse_limit is not None:
+            self.update_support(self.belief_state)
+
+    def update_support(self, belief):
+        if self.sparse_limit is None:
+            return
+
+        support = np.flatnonzero(belief)
+        self.support = support if len(support) <= self.sparse_limit * len(belief) else None
+
+    def next_belief_buffer(self, belief: np.ndarray = None) -> np.ndarray:
         """
-        Override explicit loop version for more efficient calculations
+        Belief buffer for the next update, i.e. the one not holding the (current) belief
         """
-        new_belief = self.belief_state.copy()
+        belief = self.belief_state if belief is None else belief
+        return self.belief_buffers[1] if belief is self.belief_buffers[0] else self.belief_buffers[0]
 
-        constrain_belief = observation is not None and action[1] is None
-        if constrain_belief:
-            self.obs_update(action, new_belief, observation)
+    def update_belief(self, action_type, result, response):
+        if action_type != Actions.FEEDBACK or self.support is not None:
+            super().update_belief(action_type, result, response)
+            return
 
-        # evidence is given
-        transition_happened = action[1] is not None and action[1] != observation
-        if transition_happened:
-            self.trans_update(action, new_belief)
+        # fused pass: constrain the belief by the response (ignoring the correct answer), then transition, going from
+        # one belief buffer to the other and back
+        constrained = self.calc_new_belief_in_place((result[0], None), response, self.belief_state,
+                                                    self.next_belief_buffer())
+        self.belief_state = self.calc_new_belief_in_place(result, response, constrained,
+                                                          self.next_belief_buffer(constrained))
+        self.update_support(self.belief_state)
+
+        self.see_action(action_type, result)
+
+    def calc_new_belief(self, action_type, response, result):
+        if self.support is not None:
+            new_belief = self.calc_new_sparse_belief(result, response)
+            if new_belief is not None:
+                return new_belief
+
+            # whole support eliminated, use the dense update (which then resets to the prior)
+            self.support = None
+
+        new_belief = self.calc_new_belief_in_place(result, response, self.belief_state, self.next_belief_buffer())
+        self.update_support(new_belief)
 
         return new_belief
 
-    def obs_update(self, action, new_belief, observation):
-        # Quiz/Feedback action
-        # belief can be sharpened
-        consistent_states = self.state_action_values[action[0]] == observation
+    def calc_new_belief_in_place(self, action, observation, belief, out):
+        """
+        Normalized update of the belief written into out, with the same resetting as assert_belief_is_valid
+        """
+        self.belief_update_in_place(action, observation, belief, out)
 
-        # prob of consistent concepts with observation and action --> 1-e + random result prob
-        prob_consistent = (1 - self.production_noise) + self.obs_noise_prob
-        new_belief[consistent_states] = self.belief_state[consistent_states] * prob_consistent
+        if np.max(out) == 0:
+            # inconsistent with previous state, calc only based on the prior now
+            self.belief_update_in_place(action, observation, self.prior, out)
+
+            if np.max(out) == 0:
+                np.copyto(out, self.prior)
+
+        return self.normalize(out)
+
+    def belief_update_in_place(self, action, observation, belief, out):
+        """
+        Same as belief_update_formula, but from the given belief into out without allocating
+        """
+        # belief can only be sharpened by responses to Quiz/Feedback actions (without the answer)
+        if observation is not None and action[1] is None:
+            consistent_states = np.equal(self.state_action_values[action[0]], observation, out=self.mask_buffer)
+
+            np.multiply(belief, self.obs_noise_prob, out=out)
+            consistent_belief = np.multiply(belief, (1 - self.production_noise) + self.obs_noise_prob,
+                                            out=self.scratch_buffer)
+            np.putmask(out, consistent_states, consistent_belief)
+        elif action[1] is not None and action[1] != observation:
+            self.trans_update(action, belief, out)
+        else:
+            np.copyto(out, belief)
+
+        return out
+
+    def calc_new_sparse_belief(self, action, observation):
+        """
+        Same update as belief_update_formula, but only computed on the active support and the states that can
+        gain probability. The dense belief is updated in place.
+        """
+        support = self.support
+        values = self.belief_state[support]
+
+        new_support, new_values = support, values
+        if observation is not None and action[1] is None:
+            consistent = self.state_action_values[action[0]][support] == observation
+
+            prob_consistent = (1 - self.production_noise) + self.obs_noise_prob
+            new_values = values * np.where(consistent, prob_consistent, self.obs_noise_prob)
+        elif action[1] is not None and action[1] != observation:
+            consistent_states = self.find_consistent_indices_for_transition(action)
+            if len(consistent_states) == 0:
+                return None
+
+            # which states of the support are consistent (both index arrays are sorted)
+            positions = np.minimum(np.searchsorted(consistent_states, support), len(consistent_states) - 1)
+            inconsistent = consistent_states[positions] != support
+
+            incons_belief_prob = np.sum(values[inconsistent])
+            cons_trans_prob = self.prior[consistent_states] / self.get_consistent_prior_sum(action, consistent_states)
+
+            new_support = consistent_states
+            new_values = (self.belief_state[consistent_states]
+                          + cons_trans_prob * (1 - self.transition_noise) * incons_belief_prob)
+
+            if self.transition_noise > 0 and np.any(inconsistent):
+                new_support = np.concatenate([new_support, support[inconsistent]])
+                new_values = np.concatenate([new_values, values[inconsistent] * self.transition_noise])
+
+                order = np.argsort(new_support)
+                new_support, new_values = new_support[order], new_values[order]
+
+        # shrink support to the states which are still possible
+        active = new_values > 0
+        if not np.any(active):
+            return None
+        new_support, new_values = new_support[active], new_values[active]
+
+        self.belief_state[support] = 0
+        self.belief_state[new_support] = self.normalize(new_values)
+
+        self.support = new_support if len(new_support) <= self.sparse_limit * len(self.belief_state) else None
+
+        return self.belief_state
+
+    def observation_likelihood_vec(self, action_type, action, observation):
+        # belief can only be sharpened by responses to Quiz/Feedback actions (without the answer)
+        if observation is None or action[1] is not None:
+            return 1.
 
         # prob of inconsistent concepts with observation and action --> e
-        new_belief[~consistent_states] = self.belief_state[~consistent_states] * self.obs_noise_prob
+        likelihood = np.full(len(self.belief_state), self.obs_noise_prob, dtype=self.dtype)
+
+        # prob of consistent concepts with observation and action --> 1-e + random result prob
+        consistent_states = self.concept.get_consistent_indices(action[0], observation)
+        likelihood[consistent_states] = (1 - self.production_noise) + self.obs_noise_prob
+
+        return likelihood
+
+    def transition_prediction_vec(self, action_type, action, observation):
+        # evidence is given
+        transition_happened = action[1] is not None and action[1] != observation
+        if not transition_happened:
+            return self.belief_state.copy()
+
+        return self.trans_update(action, self.belief_state, np.empty_like(self.belief_state))
+
+    def update_belief_batch(self, action_type, actions, observations):
+        """
+        :return: (candidates x hypotheses) array of the new beliefs
+        """
+        values = self.concept.get_action_values([action[0] for action in actions])
+        beliefs = np.broadcast_to(self.belief_state, values.shape)
+        observations = np.array(observations, dtype=object)
+
+        if action_type == Actions.FEEDBACK:
+            # first narrow down belief of previous state, ignoring the correct answer
+            beliefs = self.calc_new_belief_batch(values, beliefs, np.full(len(actions), None), observations)
+
+        results = np.array([action[1] for action in actions], dtype=object)
 
-    def trans_update(self, action, new_belief):
+        return self.calc_new_belief_batch(values, beliefs, results, observations)
+
+    def calc_new_belief_batch(self, values, beliefs, results, observations):
+        new_beliefs = self.belief_update_formula_batch(values, beliefs, results, observations)
+
+        # same resetting as in assert_belief_is_valid
+        invalid = np.max(new_beliefs, axis=1) == 0
+        if np.any(invalid):
+            prior_beliefs = np.broadcast_to(self.prior, (np.count_nonzero(invalid), len(self.prior)))
+            prior_beliefs = self.belief_update_formula_batch(values[invalid], prior_beliefs, results[invalid],
+                                                             observations[invalid])
+            prior_beliefs[np.max(prior_beliefs, axis=1) == 0] = self.prior
+
+            new_beliefs[invalid] = prior_beliefs
+
+        return self.normalize(new_beliefs, axis=1)
+
+    def belief_update_formula_batch(self, values, beliefs, results, observations):
+        """
+        belief_update_formula for (candidates x hypotheses) beliefs, with the concept values of the candidate actions
+        """
+        new_beliefs = np.array(beliefs)
+
+        has_obs = observations != None  # noqa: E711, elementwise comparison
+        has_result = results != None  # noqa: E711
+
+        constrain_belief = has_obs & ~has_result
+        if np.any(constrain_belief):
+            consistent = values[constrain_belief] == observations[constrain_belief, None].astype(int)
+
+            prob_consistent = (1 - self.production_noise) + self.obs_noise_prob
+            new_beliefs[constrain_belief] *= np.where(consistent, prob_consistent, self.obs_noise_prob)
+
+        # evidence is given
+        transition_happened = has_result.copy()
+        answered = has_result & has_obs
+        transition_happened[answered] = results[answered] != observations[answered]
+        if np.any(transition_happened):
+            consistent = values[transition_happened] == results[transition_happened, None].astype(int)
+            new_beliefs[transition_happened] = self.trans_update_batch(consistent, new_beliefs[transition_happened])
+
+        return new_beliefs
+
+    def trans_update_batch(self, consistent_states, beliefs):
+        memory_consistent = self.get_transition_memory_mask()
+        if memory_consistent is not None:
+            consistent_states &= memory_consistent
+
+        incons_belief_prob = np.sum(beliefs, axis=1, where=~consistent_states, keepdims=True)
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            if self.uniform_prior:
+                cons_trans_prob = 1 / np.count_nonzero(consistent_states, axis=1, keepdims=True)
+            else:
+                cons_trans_prob = self.prior / (consistent_states @ self.prior)[:, None]
+
+        transition_prob = cons_trans_prob * (1 - self.transition_noise) * incons_belief_prob
+
+        return np.where(consistent_states, beliefs + transition_prob, beliefs * self.transition_noise)
+
+    def concept_prob_evaluator(self, index, checkpoint: int):
+        if self.support is not None:
+            # sparse updates are done as usual
+            return super().concept_prob_evaluator(index, checkpoint)
+
+        # the candidates are updated with the in-place kernels into the free buffers, the state is not changed
+        def concept_prob(action_type, action, observation):
+            belief = self.belief_state
+            if action_type == Actions.FEEDBACK:
+                # same steps as the fused update
+                belief = self.calc_new_belief_in_place((action[0], None), observation, belief,
+                                                       self.next_belief_buffer())
+
+            return self.calc_new_belief_in_place(action, observation, belief, self.candidate_buffer)[index]
+
+        return concept_prob
+
+    def get_transition_memory_mask(self):
+        """
+        States allowed by the memory of the learner for any transition, None if not restricted
+        """
+        return None
+
+    def trans_update(self, action, belief, out):
+        """
+        Transition of the belief for the evidence of the action, written into out with the preallocated masks
+        """
         # state might have changed
-        consistent_states = self.find_consistent_states_for_transition(action)
+        consistent_states = np.equal(self.state_action_values[action[0]], action[1], out=self.mask_buffer)
+        memory_consistent = self.get_transition_memory_mask()
+        if memory_consistent is not None:
+            np.logical_and(consistent_states, memory_consistent, out=consistent_states)
+        inconsistent_states = np.logical_not(consistent_states, out=self.inverse_mask_buffer)
 
-        incons_belief_prob = np.sum(self.belief_state[~consistent_states])
-        new_belief[~consistent_states] = self.belief_state[~consistent_states] * self.transition_noise
+        # (gathering by boolean indexing is faster here than np.compress into a buffer)
+        incons_belief_prob = np.sum(belief[inconsistent_states])
 
-        if np.max(self.prior) == np.min(self.prior):
+        if self.uniform_prior:
             # uniform prior - probabilities are all the same
             uniform_cons_trans_prob = 1 / np.count_nonzero(consistent_states)
 
-            transition_prob = uniform_cons_trans_prob * (1 - self.transition_noise) * incons_belief_prob
-            new_belief[consistent_states] = self.belief_state[consistent_states] + transition_prob
+            transition_prob = self.dtype.type(uniform_cons_trans_prob * (1 - self.transition_noise)
+                                              * incons_belief_prob)
         else:
-            # uneven prior - calc transition for each consistent state separately
-            cons_prior_sum = np.sum(self.prior[consistent_states])
-            for idx in np.flatnonzero(consistent_states):
-                prior = self.prior[idx]
-                cons_trans_prob = prior / cons_prior_sum
+            # uneven prior - transition proportional to the prior of each consistent state; computed for all states
+            # (full array ufuncs are much faster than masked ones), only the consistent ones are used
+            cons_prior_sum = self.get_consistent_prior_sum(action, consistent_states)
+
+            transition_prob = np.divide(self.prior, self.dtype.type(cons_prior_sum), out=self.scratch_buffer)
+            transition_prob *= 1 - self.transition_noise
+            transition_prob *= incons_belief_prob
 
-                transition_prob = cons_trans_prob * (1 - self.transition_noise) * incons_belief_prob
-                new_belief[idx] = self.belief_state[idx] + transition_prob
+        np.multiply(belief, self.transition_noise, out=out)
+        transitioned = np.add(belief, transition_prob, out=self.scratch_buffer)
+        np.putmask(out, consistent_states, transitioned)
+
+        return out
 
     def find_consistent_states_for_transition(self, action):
         consistent_states = self.state_action_values[action[0]] == action[1]
         return consistent_states
 
-    # "Raw" implementations of the bayesian belief update models; more costly because of looping
+    def find_consistent_indices_for_transition(self, action):
+        return self.concept.get_consistent_indices(action[0], action[1])
+
+    def get_consistent_prior_sum(self, action, consistent_states):
+        """
+        Transition normalizer: prior mass of the states consistent with the action (given as mask or indices)
+        """
+        if self.prior is self.concept.get_prior(self.dtype):
+            # precomputed per action and value
+            obs_idx = self.concept.get_observation_idx(action[1])
+            if obs_idx is not None:
+                return self.concept.get_prior_sums(action[0])[obs_idx]
+
+        return np.sum(self.prior[consistent_states])
+
+    # "Raw" implementations of the bayesian belief update models; more costly because of looping, only used as
+    # reference in belief_update_formula_loop
     def observation_model(self, observation, new_state, action_type, action, concept_val):
         """
         Probability of seeing observation (i.e. response of the learner) in the (new) state given the taken action
@@ -108,7 +389,8 @@ class MemorylessModel(BaseBelief):
         consistent_state_filter = self.find_consistent_states_for_transition(action)
 
         # prob of going to new state
-        noisy_prior = self.prior[new_idx] / np.sum(self.prior[consistent_state_filter]) - self.transition_noise
+        noisy_prior = (self.prior[new_idx] / self.get_consistent_prior_sum(action, consistent_state_filter)
+                       - self.transition_noise)
 
         p_s = np.ones(len(self.hypotheses)) * noisy_prior  # default transition with prior probability
         p_s[consistent_state_filter] = 0  # no transition from other consistent concepts
@@ -122,22 +404,85 @@ class MemorylessModel(BaseBelief):
         pass
 
     def get_observation_prob(self, action, observation):
-        concepts_w_obs = self.state_action_values[action[0]] == observation
+        if self.support is not None:
+            concepts_w_obs = self.support[self.state_action_values[action[0]][self.support] == observation]
+        else:
+            concepts_w_obs = self.concept.get_consistent_indices(action[0], observation)
         cons_prob = np.sum(self.belief_state[concepts_w_obs])
 
         return cons_prob * (1 - self.production_noise) + self.obs_noise_prob
 
+    def sample_hidden_state(self):
+        """
+        Belief of a single hypothesis sampled from the belief (the memory of the discrete model is kept)
+        """
+        states = np.flatnonzero(self.belief_state) if self.support is None else self.support
+        probs = self.belief_state[states].astype(np.float64)
+        state = states[rand_ng.rg.choice(len(states), p=probs / np.sum(probs))]
+
+        # not in place, the belief can be the buffer of a checkpoint
+        self.belief_state = self.next_belief_buffer()
+        self.belief_state.fill(0)
+        self.belief_state[state] = 1
+        self.update_support(self.belief_state)
+
     def get_concept_prob(self, index) -> float:
         return self.belief_state[index]
 
-    def get_state(self):
+    def fingerprint(self) -> int:
+        return self.array_fingerprint(self.belief_state)
+
+    def get_belief_snapshot(self):
+        if self.support is not None:
+            return SparseBelief(self.support, self.belief_state[self.support])
+
         return self.belief_state.copy()
 
+    def set_belief_snapshot(self, snapshot):
+        if isinstance(snapshot, SparseBelief):
+            if self.support is not None:
+                self.belief_state[self.support] = 0
+            else:
+                self.belief_state = self.next_belief_buffer()
+                self.belief_state.fill(0)
+
+            self.belief_state[snapshot.indices] = snapshot.values
+            self.support = snapshot.indices
+        else:
+            self.belief_state = self.next_belief_buffer()
+            np.copyto(self.belief_state, snapshot)
+            self.update_support(self.belief_state)
+
+    def save_checkpoint(self, level):
+        if self.support is None:
+            if level == len(self.checkpoint_buffers):
+                self.checkpoint_buffers.append(np.empty_like(self.belief_state))
+
+            np.copyto(self.checkpoint_buffers[level], self.belief_state)
+            return self.checkpoint_buffers[level]
+
+        return self.get_belief_snapshot()
+
+    def restore_checkpoint(self, saved_state):
+        if isinstance(saved_state, SparseBelief):
+            self.set_belief_snapshot(saved_state)
+        else:
+            # the buffer of the checkpoint is not changed by the following (dense) updates, which write into the belief
+            # buffers
+            self.belief_state = saved_state
+            self.support = None
+
+    def get_state(self):
+        return self.get_belief_snapshot()
+
     def set_state(self, state):
-        self.belief_state = state.copy()
+        self.set_belief_snapshot(state)
 
     def reset(self):
-        self.belief_state = self.belief_state_orig.copy()
+        self.belief_state = self.next_belief_buffer()
+        np.copyto(self.belief_state, self.belief_state_orig)
+        self.update_support(self.belief_state)
 
     def __copy__(self):
-        return MemorylessModel(self.belief_state.copy(), self.prior, self.concept, verbose=self.verbose)
+        return MemorylessModel(self.belief_state.copy(), self.prior, self.concept, verbose=self.verbose,
+                               sparse_limit=self.sparse_limit, dtype=self.dtype)
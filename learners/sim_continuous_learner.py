@@ -28,17 +28,17 @@ class SimContinuousLearner(BaseLearner):
 
         self.assessment_guess = None
 
-        self.concept_action_values = self.concept.state_action_values
-
     def update_state(self, example):
         if rand_ng.rg.random() < self.transition_noise:
             # ignore change
             return
 
-        inconsistent_concepts = self.concept_action_values[example[0]] != example[1]
-        self.concept_belief[inconsistent_concepts] = 0
+        consistent_concepts = self.concept.get_consistent_indices(example[0], example[1])
+
+        new_belief = np.zeros_like(self.concept_belief)
+        new_belief[consistent_concepts] = self.concept_belief[consistent_concepts]
 
-        self.concept_belief /= np.sum(self.concept_belief)
+        self.concept_belief = new_belief / np.sum(new_belief)
 
     def see_example(self, example):
         self.assessment_guess = None
@@ -67,12 +67,9 @@ class SimContinuousLearner(BaseLearner):
             # produce random answer
             answer_sample = rand_ng.rg.choice(self.concept.get_observation_space())
         else:
-            answers = {}
-            for result in self.concept.get_observation_space():
-                concepts_w_result = self.concept_action_values[quiz[0]] == result
-                answers[result] = np.sum(self.concept_belief[concepts_w_result])
+            answer_probs = self.concept.get_partition(quiz[0]).sums(self.concept_belief)
 
-            answer_sample = rand_ng.rg.choice(list(answers.keys()), p=list(answers.values()))
+            answer_sample = rand_ng.rg.choice(self.concept.get_observation_space(), p=answer_probs)
 
         self.print("I think it is %d" % answer_sample)
 
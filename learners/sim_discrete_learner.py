@@ -37,18 +37,13 @@ class SimDiscreteLearner(SimMemorylessLearner):
             self.find_stochastically(example)
 
     def find_stochastically(self, example):
-        # TODO optimization: can be precomputed and cached
-        concepts_results = np.array([self.concept.evaluate_concept(example[0], c) for c in self.concept_space])
-        consistent_concepts_filter = concepts_results == example[1]
-        consistent_concepts_prob = self.prior_distribution[consistent_concepts_filter]
-
-        consistent_concepts = np.flatnonzero(consistent_concepts_filter)
+        consistent_concepts = self.concept.get_consistent_indices(example[0], example[1])
+        consistent_concepts_prob = self.prior_distribution[consistent_concepts]
         for memory_item in self.memory:
             if memory_item[1] is None:
                 continue
 
-            concepts_results = np.array([self.concept.evaluate_concept(memory_item[0], self.concept_space[c])
-                                         for c in consistent_concepts])
+            concepts_results = self.concept.state_action_values[memory_item[0]][consistent_concepts]
 
             consistent_concepts_filter = concepts_results == memory_item[1]
             consistent_concepts_prob = consistent_concepts_prob[consistent_concepts_filter]
@@ -99,18 +99,18 @@ class SimMemorylessLearner(BaseLearner):
             self.fill_empty_mappings()
         else:
             # Sample concept consistent with action according to prior
-            concepts_results = np.array([self.concept.evaluate_concept(example[0], c) for c in self.concept_space])
-            consistent_concepts_filter = concepts_results == example[1]
+            consistent_concepts = self.concept.get_consistent_indices(example[0], example[1])
 
-            consistent_concepts = np.flatnonzero(consistent_concepts_filter)
-
-            consistent_concepts_prob = self.prior_distribution[consistent_concepts_filter]
+            consistent_concepts_prob = self.prior_distribution[consistent_concepts]
             consistent_concepts_prob /= np.sum(consistent_concepts_prob)
 
             new_belief_idx = rand_ng.rg.choice(consistent_concepts, p=consistent_concepts_prob)
             self.concept_belief = self.concept_space[new_belief_idx]
 
     def update_values_with_pair(self, letters, pair):
+        # never modify the hypothesis row of the (shared, possibly read-only) concept space in place
+        self.concept_belief = np.array(self.concept_belief)
+
         # mark values from the pick as invalid
         for idx, val in enumerate(self.concept_belief):
             if val == pair[0] or val == pair[1]:
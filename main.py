@@ -9,6 +9,7 @@ import matplotlib.pyplot as plt
 
 from actions import Actions
 from concepts.concept_base import ConceptBase
+from concepts.concept_cache import ConceptCache
 from concepts.letter_addition import LetterAddition
 from concepts.number_game import NumberGame
 from learner_models.base_belief import DummyBelief
@@ -21,6 +22,7 @@ from learners.sim_discrete_learner import SimDiscreteLearner
 from learners.sim_memoryless_learner import SimMemorylessLearner
 from planners.forward_search import ForwardSearchPlanner
 from planners.max_information_gain import MaxInformationGainPlanner
+from planners.mcts import MCTSPlanner
 from planners.random import RandomPlanner
 from output import print_statistics_table, plot_single_errors, plot_multi_actions, plot_multi_errors, plot_multi_time, \
     plot_single_actions, save_raw_data
@@ -33,7 +35,7 @@ def setup_arguments():
                                                  'simulated learners')
     # Planning mode arguments
     parser.add_argument('planning_model', type=str, default="memoryless",
-                        choices=["memoryless", "discrete", "continuous", "random", "mig"], nargs='?',
+                        choices=["memoryless", "discrete", "continuous", "random", "mig", "mcts"], nargs='?',
                         help="Which learner model to use during planning for updating the belief")
     parser.add_argument('--actions_qe_only', action="store_true", help='Only use quizzes and examples')
 
@@ -41,6 +43,8 @@ def setup_arguments():
     parser.add_argument('task', default="letter", choices=["letter", "number_game"], help="The task to learn")
     parser.add_argument('--number_concept', default="mul7", choices=["mul7", "64-83", "mul4-1"],
                         help="The target number game concept")
+    parser.add_argument('--number_dedup', action="store_true",
+                        help="Merge number game hypotheses with identical members (summing up their priors)")
     parser.add_argument('-l', '--problem_len', type=int, default=6, help="Length of the letter addition problem")
     parser.add_argument('-r', '--number_range', type=int, default=6, help="Upper bound of the number range mapping")
 
@@ -52,6 +56,27 @@ def setup_arguments():
                         help="Horizon of the planning algorithm during online planning")
     parser.add_argument('--plan_online_samples', type=int, nargs='*',
                         help="Sample lens of the planning algorithm during online planning for each horizon step")
+    parser.add_argument('--plan_transpositions', action="store_true",
+                        help="Reuse the cost of subtrees searched from the same belief state within an online planning "
+                             "search (transposition table)")
+    parser.add_argument('--plan_transposition_reuse', type=int, default=0, metavar='N',
+                        help="Keep the N most recently used transposition table entries for the next online planning "
+                             "searches")
+    parser.add_argument('--plan_workers', type=int, default=1, metavar='N',
+                        help="Search the root items of the online planning in N parallel worker processes")
+    parser.add_argument('--plan_time_budget_ms', type=float, default=None, metavar='MS',
+                        help="Deepen the horizon of the online planning (iterative deepening) until the time budget "
+                             "runs out, instead of searching with the fixed horizon")
+    parser.add_argument('--mcts_belief', default="memoryless", choices=["memoryless", "discrete", "continuous"],
+                        help="Learner model updating the belief in the Monte Carlo tree search (mcts policy)")
+    parser.add_argument('--mcts_simulations', type=int, default=500, metavar='N',
+                        help="Number of simulations per action of the Monte Carlo tree search (0: only time budget)")
+    parser.add_argument('--mcts_time_ms', type=float, default=None, metavar='MS',
+                        help="Time budget per action of the Monte Carlo tree search in milliseconds")
+    parser.add_argument('--mcts_depth', type=int, default=4,
+                        help="Maximum depth of the simulations of the Monte Carlo tree search")
+    parser.add_argument('--mcts_exploration', type=float, default=0.3,
+                        help="UCB exploration constant of the Monte Carlo tree search, relative to the leaf cost")
     parser.add_argument('--plan_pre_steps', type=int, default=9, help="Number of precomputed planned actions")
     parser.add_argument('--plan_pre_horizon', type=int, default=2, help="Depth of horizon for precomputed actions")
     parser.add_argument('--plan_pre_samples', type=int, default=10,
@@ -59,6 +84,16 @@ def setup_arguments():
     parser.add_argument('--plan_load_actions', type=str, default=None, help="Path to file with precomputed actions")
     parser.add_argument('--particle_limit', type=int, default=16, help='Maximum number of particles for the '
                                                                        'continuous model')
+    parser.add_argument('--particle_merge', action="store_true",
+                        help="Merge identical particles of the continuous model, summing up their weights")
+    parser.add_argument('--particle_kl_bound', type=float, default=None, metavar='EPSILON',
+                        help="Adaptive particle budget: keep only as many particles (up to the limit) as needed to "
+                             "bound the KL divergence of the particle weights by EPSILON")
+    parser.add_argument('--sparse_belief', type=float, default=None, metavar='FRACTION',
+                        help="Update the memoryless/discrete belief only on its active support while at most this "
+                             "fraction of the hypotheses has non-zero probability")
+    parser.add_argument('--belief_dtype', default="float64", choices=["float64", "float32"],
+                        help="Float precision of the beliefs, particles and priors of the planning models")
 
     # Execution arguments
     parser.add_argument('-v', '--verbose', action="store_true", help="Print everything")
@@ -66,6 +101,10 @@ def setup_arguments():
     parser.add_argument('-s', '--single_run', action="store_true", help="Only run one simulation")
     parser.add_argument('-c', '--sim_count', type=int, default=50, help="Number of simulations to run")
     parser.add_argument('--sim_seed', type=int, default=123, help="Base seed for the different simulation runs")
+    parser.add_argument('--concept_cache', type=str, default='data/cache',
+                        help="Directory to cache the precomputed concept tables in")
+    parser.add_argument('--no_concept_cache', action="store_true",
+                        help="Always recompute the concept tables instead of using the cache")
     parser.add_argument('--pool', type=int, default=None, help="Number of parallel processes to run the simulation "
                                                                "in. None (default): use number of processors "
                                                                "available. 1: no parallelization")
@@ -114,14 +153,22 @@ def create_simulated_learner(args, concept: ConceptBase, prior_distribution):
 
 
 def create_belief_model(args, prior_distribution, concept):
-    if args.planning_model == 'memoryless':
-        belief = MemorylessModel(prior_distribution.copy(), prior_distribution, concept, verbose=args.verbose)
-    elif args.planning_model == 'discrete':
+    model = args.planning_model
+    if model == 'mcts':
+        model = args.mcts_belief
+
+    if model == 'memoryless':
+        belief = MemorylessModel(prior_distribution.copy(), prior_distribution, concept, verbose=args.verbose,
+                                 sparse_limit=args.sparse_belief, dtype=args.belief_dtype)
+    elif model == 'discrete':
         belief = DiscreteMemoryModel(prior_distribution.copy(), prior_distribution, concept,
-                                     memory_size=args.plan_discrete_memory, verbose=args.verbose)
-    elif args.planning_model == 'continuous' or args.planning_model == 'mig':
-        belief = ContinuousModel(prior_distribution, concept, args.particle_limit, verbose=args.verbose)
-    elif args.planning_model == 'random':
+                                     memory_size=args.plan_discrete_memory, verbose=args.verbose,
+                                     sparse_limit=args.sparse_belief, dtype=args.belief_dtype)
+    elif model == 'continuous' or model == 'mig':
+        belief = ContinuousModel(prior_distribution, concept, args.particle_limit, verbose=args.verbose,
+                                 dtype=args.belief_dtype, merge_particles=args.particle_merge,
+                                 kl_bound=args.particle_kl_bound)
+    elif model == 'random':
         belief = DummyBelief([], np.zeros(1), concept)
     else:
         raise Exception("Unknown simulation model")
@@ -143,9 +190,17 @@ def create_teacher(args, concept, belief):
         planner = RandomPlanner(concept, actions)
     elif args.planning_model == "mig":
         planner = MaxInformationGainPlanner(concept, [Actions.EXAMPLE], belief, verbose=args.verbose,)
+    elif args.planning_model == "mcts":
+        time_budget = args.mcts_time_ms / 1000 if args.mcts_time_ms else None
+        planner = MCTSPlanner(concept, actions, belief, simulations=args.mcts_simulations, time_budget=time_budget,
+                              max_depth=args.mcts_depth, exploration=args.mcts_exploration, verbose=args.verbose)
     else:
+        time_budget = args.plan_time_budget_ms / 1000 if args.plan_time_budget_ms else None
         planner = ForwardSearchPlanner(concept, actions, belief, verbose=args.verbose,
-                                       plan_horizon=args.plan_online_horizon, plan_samples=args.plan_online_samples)
+                                       plan_horizon=args.plan_online_horizon, plan_samples=args.plan_online_samples,
+                                       transpositions=args.plan_transpositions,
+                                       transposition_reuse=args.plan_transposition_reuse, workers=args.plan_workers,
+                                       time_budget=time_budget)
 
     teacher = Teacher(concept, belief, planner, args.teaching_phase_actions, args.max_teaching_phases,
                       verbose=args.verbose)
@@ -154,11 +209,16 @@ def create_teacher(args, concept, belief):
 
 
 def create_teaching_objects(args, number_range):
+    cache = None
+    if not args.no_concept_cache:
+        cache = ConceptCache(args.concept_cache)
+
     if args.task == 'number_game':
         # Space mode can be set to 'orig' to use exactly the same settings as in the original paper
-        concept = NumberGame(target_concept=args.number_concept, space_mode='default')
+        concept = NumberGame(target_concept=args.number_concept, space_mode='default', cache=cache,
+                             dedup=args.number_dedup)
     else:
-        concept = LetterAddition(args.problem_len, number_range=number_range)
+        concept = LetterAddition(args.problem_len, number_range=number_range, cache=cache)
 
     prior_distribution = concept.get_default_prior()
     assert np.isclose(np.sum(prior_distribution), 1.), \
@@ -307,6 +367,23 @@ def describe_arguments(args):
         print("Policy: Planning using maximum information gain")
         plan = "-"
         model = 'Continuous'
+        args.plan_pre_steps = 0
+        args.plan_online_horizon = 0
+    elif args.planning_model == 'mcts':
+        print("Policy: Monte Carlo tree search using a %s belief model" % args.mcts_belief)
+        model = args.mcts_belief.capitalize()
+        if args.plan_no_noise:
+            print("-- ignoring noise in belief updating")
+            model += " (w/o noise)"
+
+        budget = []
+        if args.mcts_simulations > 0:
+            budget.append("%d sims" % args.mcts_simulations)
+        if args.mcts_time_ms:
+            budget.append("%g ms" % args.mcts_time_ms)
+        plan = "MCTS %s, depth %d" % (" / ".join(budget), args.mcts_depth)
+        print("Online planning: %s" % plan)
+
         args.plan_pre_steps = 0
         args.plan_online_horizon = 0
     else:
@@ -334,10 +411,15 @@ def describe_arguments(args):
             model += " (w/o noise)"
 
         print("Precomputed actions: %d x %d x %d" % (args.plan_pre_steps, args.plan_pre_horizon, args.plan_pre_samples))
-        print("Online planning: %d x %s" % (args.plan_online_horizon, args.plan_online_samples))
-
-        plan = "%d x %d pre + %d x %s" % (args.plan_pre_steps, args.plan_pre_samples,
-                                          args.plan_online_horizon, args.plan_online_samples)
+        if args.plan_time_budget_ms:
+            print("Online planning: iterative deepening in %g ms x %s" % (args.plan_time_budget_ms,
+                                                                         args.plan_online_samples))
+            plan = "%d x %d pre + %g ms x %s" % (args.plan_pre_steps, args.plan_pre_samples,
+                                                 args.plan_time_budget_ms, args.plan_online_samples)
+        else:
+            print("Online planning: %d x %s" % (args.plan_online_horizon, args.plan_online_samples))
+            plan = "%d x %d pre + %d x %s" % (args.plan_pre_steps, args.plan_pre_samples,
+                                              args.plan_online_horizon, args.plan_online_samples)
 
     if not args.single_run:
         print("\nSimulation: %d trials" % args.sim_count)
@@ -406,6 +488,14 @@ def main():
     if args.sim_count == 1:
         args.single_run = True
 
+    if not args.single_run and args.pool != 1 and args.plan_workers > 1:
+        print("Parallel planning is not available with parallel simulations, use --pool 1")
+        args.plan_workers = 1
+
+    if args.plan_time_budget_ms and args.plan_workers > 1:
+        print("Parallel planning is not available with a planning time budget")
+        args.plan_workers = 1
+
     number_range = list(range(0, args.number_range))
 
     global_time_start = time.time()
@@ -100,6 +100,9 @@ def print_statistics_table(error_history, time_history, plan_duration_history):
 
     plan_duration_history = [item for plan_durations in plan_duration_history
                              if len(plan_durations) > 0 for item in plan_durations]
+    # searches with a time budget record (duration, depth reached)
+    plan_depth_history = [item[1] for item in plan_duration_history if isinstance(item, tuple)]
+    plan_duration_history = [item[0] if isinstance(item, tuple) else item for item in plan_duration_history]
 
     print("Online plannings done: %d" % len(plan_duration_history))
 
@@ -119,6 +122,11 @@ def print_statistics_table(error_history, time_history, plan_duration_history):
                                               np.mean(plan_duration_history), np.std(plan_duration_history)]]
         if len(plan_duration_history) > 0 else ["Planning duration", "", "", "", "", ""]
     ]
+    if len(plan_depth_history) > 0:
+        stats_arr.append(["Planning depth"] + ["%.2f" % item
+                                               for item in [np.median(plan_depth_history),
+                                                            *bootstrap_ci(plan_depth_history),
+                                                            np.mean(plan_depth_history), np.std(plan_depth_history)]])
     print(tt.to_string(stats_arr, header=["", "Median", "MD CI -", "MD CI +", "Mean", "SD"], alignment="lrrrrr"))
 
     return stats_arr
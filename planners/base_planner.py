@@ -1,8 +1,17 @@
 from abc import ABC, abstractmethod
+from typing import NamedTuple
 
 from concepts.concept_base import ConceptBase
 
 
+class PlanDuration(NamedTuple):
+    """
+    Entry of plan_duration_history for searches with a time budget, with the horizon they reached
+    """
+    duration: float
+    depth: int
+
+
 class BasePlanner(ABC):
     def __init__(self, concept: ConceptBase, actions: list):
         self.actions = actions
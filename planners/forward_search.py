@@ -1,5 +1,6 @@
 import time
 
+from collections import OrderedDict
 from copy import deepcopy
 
 import numpy as np
@@ -8,13 +9,21 @@ from tqdm import tqdm
 from actions import Actions
 from concepts.concept_base import ConceptBase
 from learner_models.base_belief import BaseBelief
-from planners.base_planner import BasePlanner
+from planners.base_planner import BasePlanner, PlanDuration
+from planners.parallel_search import RootSearchPool
 from random_ng import rand_ng
 
 
+class SearchTimeout(Exception):
+    """
+    The time budget of the search ran out
+    """
+
+
 class ForwardSearchPlanner(BasePlanner):
     def __init__(self, concept: ConceptBase, actions: list, belief: BaseBelief,
-                 plan_samples=None, plan_horizon: int = 2, verbose: bool = False):
+                 plan_samples=None, plan_horizon: int = 2, verbose: bool = False, transpositions: bool = False,
+                 transposition_reuse: int = 0, workers: int = 1, time_budget: float = None):
         super().__init__(concept, actions)
 
         self.action_count = 0
@@ -38,6 +47,22 @@ class ForwardSearchPlanner(BasePlanner):
         # position of true concept
         self.true_concept_pos = self.concept.get_true_concept_idx()
 
+        # min expected cost of already searched subtrees by (belief fingerprint, depth, sample sizes), optionally
+        # keeping the transposition_reuse most recently used entries for the following searches
+        self.transposition_table = OrderedDict() if transpositions else None
+        self.transposition_reuse = transposition_reuse
+        self.transposition_hits = 0
+
+        # with several workers, the root items are searched in parallel by a pool started on the first search
+        self.workers = workers
+        self.root_pool = None
+
+        # with a time budget (seconds), online planning deepens the horizon until the budget runs out
+        self.time_budget = time_budget
+        self.deadline = None
+        # during iterative deepening: belief fingerprint -> items searched from the belief, cheapest first
+        self.item_orders = None
+
     def perform_preplanning(self, preplan_len: int = 9, preplan_horizon: int = 2, preplan_samples: int = 10):
         if preplan_len == 0:
             return self.best_action_stack
@@ -105,6 +130,8 @@ class ForwardSearchPlanner(BasePlanner):
             self.best_action_stack = self.best_action_stack['responses'].get(prev_response)
 
             return action
+        elif self.time_budget:
+            return self.plan_best_action_in_time(self.plan_samples, self.time_budget)
         else:
             return self.plan_best_action(self.plan_horizon, self.plan_samples)
 
@@ -115,6 +142,9 @@ class ForwardSearchPlanner(BasePlanner):
         self.action_count = 0
         self.plan_duration_history = []
 
+        if self.transposition_table is not None:
+            self.transposition_table.clear()
+
     def plan_best_action(self, horizon: int, samples: list, belief: BaseBelief = None):
         if len(samples) < horizon:
             samples = [samples[0]] * horizon
@@ -127,7 +157,10 @@ class ForwardSearchPlanner(BasePlanner):
         tree = {
             "children": []
         }
-        self.forward_plan(belief.copy(), tree, horizon, samples)
+        if self.workers > 1 and horizon > 0:
+            self.forward_plan_parallel(belief, tree, horizon, samples)
+        else:
+            self.forward_plan(belief.copy(), tree, horizon, samples)
 
         plan_duration = time.time() - start_time
         if self.verbose:
@@ -136,11 +169,60 @@ class ForwardSearchPlanner(BasePlanner):
         self.plan_duration_history.append(plan_duration)
         # self.print_plan_tree(tree)
 
+        self.trim_transposition_table()
+
         # find optimal path
         action = self.find_optimal_action_path(tree)
 
         return action
 
+    def plan_best_action_in_time(self, samples: list, time_budget: float):
+        """
+        Iterative deepening: search with horizon 1, 2, 3, ... until the time budget runs out and take the best action
+        of the deepest completed search. Every belief searched before is searched with the same items again, cheapest
+        first, so that the best subtrees are found early and prune the others.
+        """
+        start_time = time.time()
+
+        belief = self.belief.copy()
+        self.item_orders = {}
+
+        tree = None
+        depth = 0
+        try:
+            while True:
+                # the first search always completes, to have an action
+                self.deadline = start_time + time_budget if tree is not None else None
+
+                next_tree = {
+                    "children": []
+                }
+                # deeper steps sample as many items as the last given one
+                sample_lens = samples[:depth + 1] + samples[-1:] * (depth + 1 - len(samples))
+                self.forward_plan(belief, next_tree, depth + 1, sample_lens)
+
+                tree = next_tree
+                depth += 1
+        except SearchTimeout:
+            pass
+        finally:
+            self.deadline = None
+            self.item_orders = None
+
+        plan_duration = time.time() - start_time
+        if self.verbose:
+            print("// planning took %.2f (horizon %d)" % (plan_duration, depth))
+
+        self.plan_duration_history.append(PlanDuration(plan_duration, depth))
+
+        self.trim_transposition_table()
+
+        return self.find_optimal_action_path(tree)
+
+    def check_deadline(self):
+        if self.deadline is not None and time.time() > self.deadline:
+            raise SearchTimeout()
+
     @staticmethod
     def find_optimal_action_path(tree, depth=1):
         actions = []
@@ -174,12 +256,78 @@ class ForwardSearchPlanner(BasePlanner):
             # estimate value of leaf: based on the estimated probability that the student knows the correct concept
             return self.estimate_belief(belief)
 
-        samples = self.sample_planning_items(sample_lens)
+        if depth == 1:
+            return self.forward_plan_last_layer(belief, parent, sample_lens)
+
+        samples, order_key = self.search_items(belief, sample_lens)
 
         child_sample_len = sample_lens[1:] if sample_lens else None
 
         # save state to reset to later
-        model_state = belief.get_state()
+        checkpoint = belief.checkpoint()
+
+        parent["costs"] = np.zeros(len(samples) * len(self.actions))
+
+        min_cost = float("Inf")
+
+        for item_idx, item in enumerate(samples):
+            costs = self.plan_item(belief, item, parent["children"], depth, child_sample_len, checkpoint, min_cost)
+
+            parent["costs"][item_idx * len(self.actions):(item_idx + 1) * len(self.actions)] = costs
+            min_cost = min(min_cost, min(costs))
+
+        belief.release(checkpoint)
+
+        self.store_item_order(order_key, samples, parent["costs"])
+
+        return parent["costs"].min()
+
+    def plan_item(self, belief: BaseBelief, item, children: list, depth: int, child_sample_len: list, checkpoint: int,
+                  min_cost: float) -> list:
+        """
+        Expected costs of teaching the item with every action, appending the action nodes to children. Subtrees that
+        cannot get cheaper than min_cost are not searched completely.
+        """
+        self.check_deadline()
+
+        value = self.concept.evaluate_concept(item)
+        result = (item, value)
+
+        costs = []
+        for teaching_action in self.actions:
+
+            val = self.concept.ACTION_COSTS[teaching_action]
+
+            new_node = {
+                "children": [],
+                "item": result,
+                "action": teaching_action
+            }
+
+            val += self.plan_single_action(belief, child_sample_len, depth, checkpoint, new_node, result,
+                                           teaching_action, min_cost, val)
+
+            # propagate back up
+            new_node["value"] = val
+
+            if val < min_cost:
+                min_cost = val
+
+            children.append(new_node)
+            costs.append(val)
+
+        return costs
+
+    def forward_plan_last_layer(self, belief: BaseBelief, parent, sample_lens: list = None):
+        """
+        forward_plan at depth 1, without recursing to the leaves: their values are computed directly by the belief
+        model, without changing the belief. The costs (and pruning) are exactly the same as in the recursive search.
+        """
+        samples, order_key = self.search_items(belief, sample_lens)
+        observations = self.concept.get_observation_space()
+
+        checkpoint = belief.checkpoint()
+        concept_prob = belief.concept_prob_evaluator(self.true_concept_pos, checkpoint)
 
         parent["costs"] = np.zeros(len(samples) * len(self.actions))
         item_index = 0
@@ -187,45 +335,120 @@ class ForwardSearchPlanner(BasePlanner):
         min_cost = float("Inf")
 
         for item in samples:
-            value = self.concept.evaluate_concept(item)
-            result = (item, value)
+            self.check_deadline()
+
+            result = (item, self.concept.evaluate_concept(item))
+
+            # the same for quizzes and feedback, computed when needed
+            obs_probs = None
 
             for teaching_action in self.actions:
+                action_cost = self.concept.ACTION_COSTS[teaching_action]
 
-                val = self.concept.ACTION_COSTS[teaching_action]
+                # same accumulation and pruning as plan_single_action
+                if teaching_action == Actions.EXAMPLE:
+                    val = self.gamma * self.estimate_concept_prob(concept_prob(teaching_action, result, None))
+                else:
+                    if obs_probs is None:
+                        obs_probs = [belief.get_observation_prob(result, observation) for observation in observations]
 
-                new_node = {
-                    "children": [],
-                    "item": result,
-                    "action": teaching_action
-                }
+                    action = (item, None) if teaching_action == Actions.QUIZ else result
+
+                    val = 0
+                    for observation, obs_prob in zip(observations, obs_probs):
+                        if obs_prob == 0:
+                            continue
+
+                        leaf_val = self.estimate_concept_prob(concept_prob(teaching_action, action, observation))
+                        val += self.gamma * obs_prob * leaf_val
 
-                val += self.plan_single_action(belief, child_sample_len, depth, model_state, new_node, result,
-                                               teaching_action, min_cost, val)
+                        if (val + action_cost) > min_cost:
+                            break
 
-                # propagate back up
-                new_node["value"] = val
+                val = action_cost + val
+
+                parent["children"].append({
+                    "children": [],
+                    "item": result,
+                    "action": teaching_action,
+                    "value": val
+                })
 
                 if val < min_cost:
                     min_cost = val
 
-                parent["children"].append(new_node)
-
                 parent["costs"][item_index] = val
                 item_index += 1
 
+        belief.release(checkpoint)
+
+        self.store_item_order(order_key, samples, parent["costs"])
+
         return parent["costs"].min()
 
-    def plan_single_action(self, belief: BaseBelief, child_sample_len: list, depth: int, model_state, new_node, result,
-                           teaching_action, best_val, action_cost):
+    def forward_plan_parallel(self, belief: BaseBelief, parent, depth, sample_lens: list = None):
+        """
+        forward_plan, with the subtrees of the root items searched by the worker pool
+        """
+        if self.root_pool is None:
+            self.root_pool = RootSearchPool(self, belief, self.workers)
+
+        samples = self.sample_planning_items(sample_lens)
+        child_sample_len = sample_lens[1:] if sample_lens else None
+
+        item_costs = self.root_pool.plan_items(belief, samples, depth, child_sample_len)
+
+        for item, costs in zip(samples, item_costs):
+            result = (item, self.concept.evaluate_concept(item))
+
+            for teaching_action, val in zip(self.actions, costs):
+                parent["children"].append({
+                    "children": [],
+                    "item": result,
+                    "action": teaching_action,
+                    "value": val
+                })
+
+        parent["costs"] = np.array([val for costs in item_costs for val in costs])
+
+        return parent["costs"].min()
+
+    def trim_transposition_table(self):
+        if self.transposition_table is not None:
+            # the belief changes between searches, so most entries will not be reached again
+            while len(self.transposition_table) > self.transposition_reuse:
+                self.transposition_table.popitem(last=False)
+
+    def forward_plan_cached(self, belief: BaseBelief, parent, depth, sample_lens: list = None):
+        """
+        forward_plan, looking up the cost of subtrees already searched from the same belief in the transposition table
+        """
+        if self.transposition_table is None or depth <= 0:
+            return self.forward_plan(belief, parent, depth, sample_lens)
+
+        key = (belief.fingerprint(), depth, tuple(sample_lens) if sample_lens else None)
+
+        cost = self.transposition_table.get(key)
+        if cost is not None:
+            self.transposition_hits += 1
+            self.transposition_table.move_to_end(key)
+            return cost
+
+        cost = self.forward_plan(belief, parent, depth, sample_lens)
+        self.transposition_table[key] = cost
+
+        return cost
+
+    def plan_single_action(self, belief: BaseBelief, child_sample_len: list, depth: int, checkpoint: int, new_node,
+                           result, teaching_action, best_val, action_cost):
         if teaching_action == Actions.EXAMPLE:
             # no observations
             expected_obs = None
 
             belief.update_belief(teaching_action, result, expected_obs)
-            val = self.gamma * self.forward_plan(belief, new_node, depth - 1, child_sample_len)
+            val = self.gamma * self.forward_plan_cached(belief, new_node, depth - 1, child_sample_len)
 
-            belief.set_state(model_state)
+            belief.rollback(checkpoint)
         else:
             val = 0
 
@@ -241,9 +464,9 @@ class ForwardSearchPlanner(BasePlanner):
 
                 belief.update_belief(teaching_action, result, expected_obs)
 
-                val += self.gamma * obs_prob * self.forward_plan(belief, new_node, depth - 1, child_sample_len)
+                val += self.gamma * obs_prob * self.forward_plan_cached(belief, new_node, depth - 1, child_sample_len)
 
-                belief.set_state(model_state)
+                belief.rollback(checkpoint)
 
                 if (val + action_cost) > best_val:
                     # print("Canceled calculating more obs - cannot get better")
@@ -251,6 +474,27 @@ class ForwardSearchPlanner(BasePlanner):
 
         return val
 
+    def search_items(self, belief: BaseBelief, sample_lens: list):
+        """
+        Items to search from the belief, and the key to store their order under during iterative deepening (None
+        otherwise); then the items of an earlier search from the same belief are reused
+        """
+        if self.item_orders is None:
+            return self.sample_planning_items(sample_lens), None
+
+        key = belief.fingerprint()
+
+        samples = self.item_orders.get(key)
+        if samples is None or len(samples) != (sample_lens[0] if sample_lens else len(self.concept.get_rl_actions())):
+            samples = self.sample_planning_items(sample_lens)
+
+        return samples, key
+
+    def store_item_order(self, key, samples: list, costs: np.ndarray):
+        if key is not None:
+            item_costs = costs.reshape(len(samples), len(self.actions)).min(axis=1)
+            self.item_orders[key] = [samples[i] for i in np.argsort(item_costs, kind='stable')]
+
     def sample_planning_items(self, sample_lens):
         combinations = self.concept.get_rl_actions()
         if sample_lens:
@@ -264,8 +508,11 @@ class ForwardSearchPlanner(BasePlanner):
         return samples
 
     def estimate_belief(self, belief: BaseBelief):
+        return self.estimate_concept_prob(belief.get_concept_prob(self.true_concept_pos))
+
+    def estimate_concept_prob(self, concept_prob):
         # TODO move to concept;
         # TODO note: not defined for number game? assume same
         # cost for a leaf node to be the probability of not passing the assessment phase multiplied by 10 * min_a(r(a))
-        belief_val = (1 - belief.get_concept_prob(self.true_concept_pos)) * 10 * min(self.concept.ACTION_COSTS.values())
+        belief_val = (1 - concept_prob) * 10 * min(self.concept.ACTION_COSTS.values())
         return belief_val
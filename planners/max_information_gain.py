@@ -10,6 +10,12 @@ from random_ng import rand_ng
 
 
 class MaxInformationGainPlanner(BasePlanner):
+    # maximum number of particle values updated at once
+    BATCH_ELEMENTS = 2 ** 19
+    # gains this close to the maximum are ties: the batched entropies are summed in a different order than one by one,
+    # so equal gains can differ in the last bits
+    GAIN_TIE_TOLERANCE = 1e-9
+
     def __init__(self, concept: ConceptBase, actions: list, belief: BaseBelief, verbose: bool = False):
         super().__init__(concept, actions)
 
@@ -47,48 +53,39 @@ class MaxInformationGainPlanner(BasePlanner):
 
     def find_max_gain_item(self, belief: ContinuousModel):
         samples = self.concept.get_rl_actions()
+        results = [(item, self.concept.evaluate_concept(item)) for item in samples]
 
-        # save state to reset to later
-        model_state = belief.get_state()
-
-        # max_gain = -1
-        gains = []
-        # best_action = None
-        actions = []
-
-        entropy_before = self.calc_entropy(belief)
-
-        for item in samples:
-            value = self.concept.evaluate_concept(item)
-            result = (item, value)
-
-            for teaching_action in self.actions:
+        # only examples change the belief without observations, other actions have no gain
+        gains = np.zeros((len(results), len(self.actions)))
+        if Actions.EXAMPLE in self.actions:
+            entropy_before = self.calc_entropy(belief)
 
-                cur_gain = self.calc_information_gain(belief, result, teaching_action, entropy_before)
-                belief.set_state(model_state)
+            gains[:, self.actions.index(Actions.EXAMPLE)] = entropy_before - self.calc_example_entropies(belief, results)
 
-                gains.append(cur_gain)
-                actions.append((teaching_action,) + result)
+        gains = gains.ravel()
+        actions = [(teaching_action,) + result for result in results for teaching_action in self.actions]
 
-        gains = np.array(gains)
-        max_idxs = np.flatnonzero(gains.max() == gains)
+        return actions[rand_ng.rg.choice(self.max_gain_indices(gains))]
 
-        return actions[rand_ng.rg.choice(max_idxs)]
+    def max_gain_indices(self, gains: np.ndarray) -> np.ndarray:
+        return np.flatnonzero(gains >= gains.max() - self.GAIN_TIE_TOLERANCE)
 
-    def calc_information_gain(self, belief: ContinuousModel, result, teaching_action, entropy_before):
-        gain = 0
+    def calc_example_entropies(self, belief: ContinuousModel, results):
+        """
+        Entropy of the belief after showing each of the examples, updated in batches
+        """
+        # limit the size of the particle tensors
+        particle_size = 2 * len(belief.particle_dists) * len(self.concept_space)
+        batch_size = max(1, self.BATCH_ELEMENTS // particle_size)
 
-        if teaching_action == Actions.EXAMPLE:
-            # no observations
-            expected_obs = None
+        entropies = []
+        for start in range(0, len(results), batch_size):
+            batch = results[start:start + batch_size]
 
-            belief.update_belief(teaching_action, result, expected_obs)
+            dists, weights = belief.update_belief_batch(Actions.EXAMPLE, batch, [None] * len(batch))
+            entropies.append(self.calc_entropy_batch(dists, weights))
 
-            entropy_after = self.calc_entropy(belief)
-
-            gain = entropy_before - entropy_after
-
-        return gain
+        return np.concatenate(entropies)
 
     @staticmethod
     def calc_entropy(belief: ContinuousModel):
@@ -101,3 +98,13 @@ class MaxInformationGainPlanner(BasePlanner):
             total_entropy += belief.particle_weights[idx] * entropy
 
         return total_entropy
+
+    @staticmethod
+    def calc_entropy_batch(dists: np.ndarray, weights: np.ndarray):
+        """
+        Entropy of (candidates x particles x hypotheses) particle distributions with (candidates x particles) weights
+        """
+        log_dists = np.log(dists, out=np.zeros_like(dists), where=dists > 0)
+        entropies = -np.einsum('kpn,kpn->kp', dists, log_dists)
+
+        return np.sum(entropies * weights, axis=1)
@@ -0,0 +1,304 @@
+import math
+import time
+
+import numpy as np
+
+from actions import Actions
+from concepts.concept_base import ConceptBase
+from learner_models.base_belief import BaseBelief
+from planners.base_planner import BasePlanner
+from random_ng import rand_ng
+
+# an action node is complete once its sampled observations cover this much of its observation probability
+COMPLETE_COVERAGE = 0.95
+
+
+class BeliefNode:
+    """
+    Belief reached by a sequence of actions and observations, with the actions of the items sampled so far
+    """
+
+    def __init__(self):
+        self.visits = 0
+        # mean discounted cost of the simulations from the belief
+        self.simulation_cost = 0.
+        # expected discounted cost of the best action (like the forward search), or the simulation cost until the
+        # expected cost of an action is known
+        self.cost = 0.
+
+        self.items = set()
+        self.children = []
+
+    def update_cost(self, simulation_cost: float):
+        self.visits += 1
+        self.simulation_cost += (simulation_cost - self.simulation_cost) / self.visits
+
+        costs = [child.cost for child in self.children if child.complete]
+        self.cost = min(costs) if len(costs) > 0 else self.simulation_cost
+
+
+class ActionNode:
+    """
+    Teaching action (item and action type) in the search tree. Its cost is the expected cost of the beliefs reached by
+    the sampled observations, weighted by their probabilities under the belief (renormalized to the observations
+    sampled so far), which is less noisy than the mean of the simulations.
+    """
+
+    def __init__(self, teaching_action: Actions, result):
+        self.teaching_action = teaching_action
+        self.result = result
+
+        self.visits = 0
+        self.cost = 0.
+        # probability of the observations sampled so far
+        self.coverage = 0.
+
+        # observation probabilities in the belief of the parent, computed on the first visit ([1] for examples)
+        self.obs_probs = None
+        # observation index -> BeliefNode
+        self.children = {}
+
+    def update_cost(self, action_cost: float, gamma: float):
+        self.visits += 1
+
+        probs = np.array([self.obs_probs[obs_idx] for obs_idx in self.children])
+        costs = np.array([child.cost for child in self.children.values()])
+
+        self.coverage = np.sum(probs)
+        self.cost = action_cost + gamma * (probs @ costs) / self.coverage
+
+    @property
+    def complete(self) -> bool:
+        return self.coverage >= COMPLETE_COVERAGE
+
+
+class MCTSPlanner(BasePlanner):
+    """
+    Monte Carlo tree search over the belief model, with UCB over the (item, action) pairs, whose items are widened
+    progressively with the visits of a node, so only a few of them are tried in the deeper nodes.
+
+    As in POMCP, every simulation starts by sampling a hidden state of the learner from the belief (a hypothesis of the
+    memoryless/discrete models, a particle of the continuous model). The responses along the simulation are sampled
+    from it, and it follows its own transitions, so the tree grows along sampled trajectories; the belief is updated
+    with the same actions and responses, continuing with random examples below the tree. The costs are backed up as in
+    the forward search (expectation over the observations sampled so far, best complete action), so they converge to
+    its costs for the same depth.
+    """
+
+    def __init__(self, concept: ConceptBase, actions: list, belief: BaseBelief, simulations: int = 500,
+                 time_budget: float = None, max_depth: int = 4, exploration: float = 0.3, widening: float = 1.,
+                 widening_exponent: float = 0.5, verbose: bool = False):
+        super().__init__(concept, actions)
+
+        assert simulations > 0 or time_budget, "MCTS needs a simulation or time budget"
+
+        self.belief = belief
+
+        # budget of one search: number of simulations and/or seconds (0 or None: unlimited)
+        self.simulations = simulations
+        self.time_budget = time_budget
+
+        self.max_depth = max_depth
+        self.gamma = 0.99
+
+        # exploration constant relative to the cost of a leaf of a belief without any knowledge of the true concept
+        self.exploration = exploration * 10 * min(self.concept.ACTION_COSTS.values())
+
+        # a node with n visits has ceil(widening * n ^ widening_exponent) items
+        self.widening = widening
+        self.widening_exponent = widening_exponent
+
+        self.verbose = verbose
+
+        # examples (without the noise of sampled observations) after the tree, random actions without examples
+        self.rollout_action = Actions.EXAMPLE if Actions.EXAMPLE in actions else None
+
+        self.items = self.concept.get_rl_actions()
+        self.observations = self.concept.get_observation_space()
+
+        # position of true concept
+        self.true_concept_pos = self.concept.get_true_concept_idx()
+
+        # simulations of the last search
+        self.simulation_count = 0
+
+    def perform_preplanning(self, preplan_len=None, preplan_horizon=None, preplan_samples=None):
+        pass
+
+    def load_preplanning(self, data):
+        pass
+
+    def start_teaching_phase(self):
+        pass
+
+    def reset(self):
+        self.plan_duration_history = []
+
+    def choose_action(self, prev_response=None):
+        start_time = time.time()
+
+        action = self.plan_best_action(self.belief.copy())
+
+        plan_duration = time.time() - start_time
+        self.plan_duration_history.append(plan_duration)
+        if self.verbose:
+            print("// planning took %.2f (%d simulations)" % (plan_duration, self.simulation_count))
+
+        return action
+
+    def plan_best_action(self, belief: BaseBelief):
+        root = self.search(belief)
+
+        # cheapest expected cost, of the complete actions if there are any
+        complete = any(node.complete for node in root.children)
+        costs = np.array([node.cost if node.complete or (not complete and node.visits > 0) else np.inf
+                          for node in root.children])
+        best = root.children[rand_ng.rg.choice(np.flatnonzero(costs == costs.min()))]
+
+        return best.teaching_action, best.result[0], best.result[1]
+
+    def search(self, belief: BaseBelief) -> BeliefNode:
+        """
+        Tree of the simulations from the belief until the budget runs out; the belief is returned to its state
+        """
+        root = BeliefNode()
+
+        # hidden state of the learner, sampled from the belief for every simulation
+        learner = belief.copy()
+
+        deadline = time.time() + self.time_budget if self.time_budget else None
+        checkpoint = belief.checkpoint()
+        learner_checkpoint = learner.checkpoint()
+
+        self.simulation_count = 0
+        while True:
+            learner.sample_hidden_state()
+            root.update_cost(self.simulate(belief, learner, root, self.max_depth))
+            belief.rollback(checkpoint)
+            learner.rollback(learner_checkpoint)
+
+            self.simulation_count += 1
+            if 0 < self.simulations <= self.simulation_count:
+                break
+            if deadline is not None and time.time() >= deadline:
+                break
+
+        belief.release(checkpoint)
+
+        return root
+
+    def simulate(self, belief: BaseBelief, learner: BaseBelief, node: BeliefNode, depth: int) -> float:
+        """
+        Discounted cost of one simulation from the node, updating the belief and the hidden learner along the way
+        """
+        if depth <= 0:
+            return self.estimate_belief(belief)
+
+        self.widen(node)
+
+        child = self.select_action(node)
+        teaching_action = child.teaching_action
+        action_cost = self.concept.ACTION_COSTS[teaching_action]
+
+        if child.obs_probs is None:
+            child.obs_probs = self.observation_probs(belief, teaching_action, child.result)
+
+        obs_idx = self.sample_response(learner, teaching_action, child.result)
+        self.perform_action(belief, teaching_action, child.result, obs_idx)
+
+        next_node = child.children.get(obs_idx)
+        if next_node is None:
+            # new leaf: continue with random examples, so that all simulations end at the same depth
+            next_node = child.children[obs_idx] = BeliefNode()
+            future_cost = self.rollout(belief, learner, depth - 1)
+        else:
+            future_cost = self.simulate(belief, learner, next_node, depth - 1)
+
+        next_node.update_cost(future_cost)
+        child.update_cost(action_cost, self.gamma)
+
+        return action_cost + self.gamma * future_cost
+
+    def rollout(self, belief: BaseBelief, learner: BaseBelief, depth: int) -> float:
+        """
+        Discounted cost of random actions until the depth, updating the belief and the hidden learner
+        """
+        if depth <= 0:
+            return self.estimate_belief(belief)
+
+        item = self.items[rand_ng.rg.integers(len(self.items))]
+        result = (item, self.concept.evaluate_concept(item))
+
+        teaching_action = self.rollout_action
+        if teaching_action is None:
+            teaching_action = self.actions[rand_ng.rg.integers(len(self.actions))]
+
+        obs_idx = self.sample_response(learner, teaching_action, result)
+        self.perform_action(belief, teaching_action, result, obs_idx)
+
+        return self.concept.ACTION_COSTS[teaching_action] + self.gamma * self.rollout(belief, learner, depth - 1)
+
+    def sample_response(self, learner: BaseBelief, teaching_action: Actions, result) -> int:
+        """
+        Index of the observation sampled from the hidden learner, which is then updated with it and sampled again
+        (i.e. it follows its transition model)
+        """
+        obs_probs = self.observation_probs(learner, teaching_action, result)
+        obs_idx = rand_ng.rg.choice(len(obs_probs), p=obs_probs)
+
+        self.perform_action(learner, teaching_action, result, obs_idx)
+        learner.sample_hidden_state()
+
+        return obs_idx
+
+    def observation_probs(self, belief: BaseBelief, teaching_action: Actions, result) -> np.ndarray:
+        if teaching_action == Actions.EXAMPLE:
+            # no observations
+            return np.ones(1)
+
+        obs_probs = np.array([belief.get_observation_prob(result, observation) for observation in self.observations])
+        return obs_probs / np.sum(obs_probs)
+
+    def perform_action(self, belief: BaseBelief, teaching_action: Actions, result, obs_idx: int):
+        if teaching_action == Actions.EXAMPLE:
+            belief.update_belief(teaching_action, result, None)
+            return
+
+        # no evidence is given to the learner by quizzes
+        action = (result[0], None) if teaching_action == Actions.QUIZ else result
+        belief.update_belief(teaching_action, action, self.observations[obs_idx])
+
+    def widen(self, node: BeliefNode):
+        """
+        Add the actions of a new random item to the node while it has fewer than allowed by its visits
+        """
+        allowed = min(math.ceil(self.widening * max(node.visits, 1) ** self.widening_exponent), len(self.items))
+
+        while len(node.items) < allowed:
+            item_idx = rand_ng.rg.integers(len(self.items))
+            if item_idx in node.items:
+                continue
+
+            node.items.add(item_idx)
+
+            item = self.items[item_idx]
+            result = (item, self.concept.evaluate_concept(item))
+            node.children.extend(ActionNode(teaching_action, result) for teaching_action in self.actions)
+
+    def select_action(self, node: BeliefNode) -> ActionNode:
+        """
+        Child with the lowest cost bound (UCB for costs), trying every action once first
+        """
+        unvisited = [child for child in node.children if child.visits == 0]
+        if len(unvisited) > 0:
+            return unvisited[rand_ng.rg.integers(len(unvisited))]
+
+        log_visits = math.log(node.visits)
+        bounds = [child.cost - self.exploration * math.sqrt(log_visits / child.visits) for child in node.children]
+
+        return node.children[int(np.argmin(bounds))]
+
+    def estimate_belief(self, belief: BaseBelief):
+        # same leaf cost as the forward search: probability of not passing the assessment phase * 10 * min_a(r(a))
+        concept_prob = belief.get_concept_prob(self.true_concept_pos)
+        return (1 - concept_prob) * 10 * min(self.concept.ACTION_COSTS.values())
@@ -0,0 +1,154 @@
+import io
+import pickle
+import weakref
+from multiprocessing import Pool
+from multiprocessing.shared_memory import SharedMemory
+from typing import List, NamedTuple
+
+import numpy as np
+
+from learner_models.base_belief import BaseBelief
+from random_ng import rand_ng
+
+
+class SharedTable(NamedTuple):
+    name: str
+    shape: tuple
+    dtype: str
+
+
+class SharedTablePickler(pickle.Pickler):
+    """
+    Pickler storing references to the shared tables instead of their content, wherever they occur in the objects
+    """
+
+    def __init__(self, file, tables: dict):
+        super().__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        # id of the array -> SharedTable
+        self.tables = tables
+
+    def persistent_id(self, obj):
+        if isinstance(obj, np.ndarray):
+            return self.tables.get(id(obj))
+
+        return None
+
+
+class SharedTableUnpickler(pickle.Unpickler):
+    """
+    Unpickler mapping the referenced shared tables as read-only arrays, the same array for every reference
+    """
+
+    def __init__(self, file):
+        super().__init__(file)
+        self.arrays = {}
+        self.memory = []
+
+    def persistent_load(self, table: SharedTable):
+        array = self.arrays.get(table.name)
+        if array is None:
+            memory = SharedMemory(table.name)
+            self.memory.append(memory)
+
+            array = np.ndarray(table.shape, dtype=table.dtype, buffer=memory.buf)
+            array.flags.writeable = False
+            self.arrays[table.name] = array
+
+        return array
+
+
+# planner of the worker process, created by init_worker
+worker_planner = None
+worker_memory = []
+
+
+def init_worker(payload: bytes):
+    global worker_planner
+
+    # imported here to avoid the circular import with the forward search
+    from planners.forward_search import ForwardSearchPlanner
+
+    unpickler = SharedTableUnpickler(io.BytesIO(payload))
+    concept, actions, belief, gamma, transpositions, transposition_reuse = unpickler.load()
+    # keep the shared memory mapped as long as the worker lives
+    worker_memory.extend(unpickler.memory)
+
+    worker_planner = ForwardSearchPlanner(concept, actions, belief, transpositions=transpositions,
+                                          transposition_reuse=transposition_reuse)
+    worker_planner.gamma = gamma
+
+
+def plan_root_item(state, item, seed: int, depth: int, child_sample_len: list) -> list:
+    """
+    Costs of the actions of one root item, searched from the given belief state
+    """
+    planner = worker_planner
+    belief = planner.belief
+
+    rand_ng.seed(seed)
+    belief.set_state(state)
+
+    checkpoint = belief.checkpoint()
+    costs = planner.plan_item(belief, item, [], depth, child_sample_len, checkpoint, float("Inf"))
+    belief.release(checkpoint)
+
+    planner.trim_transposition_table()
+
+    return costs
+
+
+def close_pool(pool, memory: List[SharedMemory]):
+    pool.terminate()
+    pool.join()
+
+    for block in memory:
+        block.close()
+        block.unlink()
+
+
+class RootSearchPool:
+    """
+    Persistent worker processes searching the subtrees of the root items of the forward search in parallel.
+
+    The concept tables are copied once into shared memory, which all workers map. Every root item is searched with
+    its own random seed, so the costs do not depend on the number of workers or the order the items are finished in.
+    """
+
+    def __init__(self, planner, belief: BaseBelief, workers: int):
+        self.memory = []
+
+        tables = {}
+        for array in planner.concept.get_shared_tables():
+            if id(array) in tables:
+                continue
+
+            memory = SharedMemory(create=True, size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype, buffer=memory.buf)[...] = array
+            self.memory.append(memory)
+
+            tables[id(array)] = SharedTable(memory.name, array.shape, array.dtype.str)
+
+        payload = io.BytesIO()
+        SharedTablePickler(payload, tables).dump((planner.concept, planner.actions, belief, planner.gamma,
+                                                  planner.transposition_table is not None,
+                                                  planner.transposition_reuse))
+
+        self.pool = Pool(processes=workers, initializer=init_worker, initargs=(payload.getvalue(),))
+
+        # shut down the workers and free the shared memory with the planner, or at the latest on exit
+        self.finalizer = weakref.finalize(self, close_pool, self.pool, self.memory)
+
+    def plan_items(self, belief: BaseBelief, items: list, depth: int, child_sample_len: list) -> List[list]:
+        """
+        Costs of the actions of every root item, in the order of the items
+        """
+        state = belief.get_state()
+        seeds = rand_ng.rg.integers(np.iinfo(np.int64).max, size=len(items))
+
+        tasks = [self.pool.apply_async(plan_root_item, (state, item, int(seed), depth, child_sample_len))
+                 for item, seed in zip(items, seeds)]
+
+        return [task.get() for task in tasks]
+
+    def close(self):
+        self.finalizer()
@@ -2,6 +2,9 @@ import numpy as np
 
 from actions import Actions
 from concepts.letter_addition import LetterAddition
+from concepts.number_game import NumberGame
+from learner_models.base_belief import BaseBelief
+from learner_models.continuous import ContinuousModel
 from learner_models.discrete import DiscreteMemoryModel
 from learner_models.memoryless import MemorylessModel
 from random_ng import rand_ng
@@ -266,4 +269,310 @@ def create_test_belief_discrete(concept, cur_belief=None):
     return belief
 
 
+def test_sparse_belief_matches_dense():
+    rand_ng.seed(123)
+
+    for concept in [LetterAddition(4), NumberGame()]:
+        prior = concept.get_default_prior()
+        observations = concept.get_observation_space()
+
+        for model_class, kwargs in [(MemorylessModel, {}), (DiscreteMemoryModel, {'memory_size': 2})]:
+            for noise in [True, False]:
+                dense = model_class(prior.copy(), prior, concept, **kwargs)
+                sparse = model_class(prior.copy(), prior, concept, sparse_limit=1., **kwargs)
+                if not noise:
+                    for belief in [dense, sparse]:
+                        belief.transition_noise = 0
+                        belief.production_noise = 0
+                        belief.obs_noise_prob = 0
+
+                for _ in range(12):
+                    equation = concept.rl_actions[rand_ng.rg.choice(len(concept.rl_actions))]
+                    action_type = rand_ng.rg.choice([Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK])
+                    true = concept.evaluate_concept(equation) if action_type != Actions.QUIZ else None
+                    response = observations[rand_ng.rg.choice(len(observations))] \
+                        if action_type != Actions.EXAMPLE else None
+
+                    states = dense.get_state(), sparse.get_state()
+                    for belief in [dense, sparse]:
+                        belief.update_belief(action_type, (equation, true), response)
+
+                    assert np.allclose(dense.belief_state, sparse.belief_state)
+                    assert np.isclose(dense.get_observation_prob((equation, None), observations[0]),
+                                      sparse.get_observation_prob((equation, None), observations[0]))
+
+                # restoring the snapshot from before the last update
+                dense.set_state(states[0])
+                sparse.set_state(states[1])
+                assert np.allclose(dense.belief_state, sparse.belief_state)
+
+
+def test_vectorized_update_matches_loop():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(4)
+    observations = concept.get_observation_space()
+
+    for belief in [create_test_belief_memoryless(concept), create_test_belief_discrete(concept)]:
+        belief.obs_noise_prob = 0
+
+        for _ in range(8):
+            equation = concept.rl_actions[rand_ng.rg.choice(len(concept.rl_actions))]
+            if rand_ng.rg.random() < .5:
+                action_type, action, response = Actions.EXAMPLE, (equation, concept.evaluate_concept(equation)), None
+            else:
+                action_type, action = Actions.QUIZ, (equation, None)
+                response = observations[rand_ng.rg.choice(len(observations))]
+
+            expected = belief.belief_update_formula_loop(action_type, action, response)
+            assert np.allclose(belief.belief_update_formula(action_type, action, response), expected)
+
+            belief.update_belief(action_type, action, response)
+
+
+def test_update_belief_batch():
+    rand_ng.seed(123)
+
+    for concept in [LetterAddition(4), NumberGame()]:
+        prior = concept.get_default_prior()
+        observations = concept.get_observation_space()
+
+        for belief in [MemorylessModel(prior.copy(), prior, concept),
+                       DiscreteMemoryModel(prior.copy(), prior, concept, memory_size=2)]:
+            for _ in range(4):
+                items = [concept.rl_actions[i] for i in rand_ng.rg.choice(len(concept.rl_actions), 5)]
+
+                for action_type in [Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK]:
+                    actions = [(item, None if action_type == Actions.QUIZ else concept.evaluate_concept(item))
+                               for item in items]
+                    responses = [None if action_type == Actions.EXAMPLE else rand_ng.rg.choice(observations)
+                                 for _ in items]
+
+                    posteriors = belief.update_belief_batch(action_type, actions, responses)
+                    assert posteriors.shape == (len(items), len(prior))
+
+                    state = belief.get_state()
+                    for idx, (action, response) in enumerate(zip(actions, responses)):
+                        belief.update_belief(action_type, action, response)
+                        assert np.allclose(posteriors[idx], belief.belief_state)
+
+                        belief.set_state(state)
+
+                belief.update_belief(Actions.EXAMPLE, (items[0], concept.evaluate_concept(items[0])), None)
+
+
+def test_in_place_update_kernels():
+    rand_ng.seed(123)
+
+    concept = NumberGame()
+    prior = concept.get_default_prior()
+
+    for belief in [MemorylessModel(prior.copy(), prior, concept),
+                   DiscreteMemoryModel(prior.copy(), prior, concept, memory_size=2)]:
+        reference = belief.copy()
+        buffers = belief.belief_buffers
+
+        for _ in range(12):
+            item = concept.rl_actions[rand_ng.rg.choice(len(concept.rl_actions))]
+            action_type = [Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK][rand_ng.rg.choice(3)]
+            action = (item, None if action_type == Actions.QUIZ else concept.evaluate_concept(item))
+            response = None if action_type == Actions.EXAMPLE else int(rand_ng.rg.choice(2))
+
+            # the fused feedback update gives the same result as the two separate passes
+            belief.update_belief(action_type, action, response)
+            BaseBelief.update_belief(reference, action_type, action, response)
+            assert np.array_equal(belief.belief_state, reference.belief_state)
+
+            # no new belief arrays
+            assert belief.belief_buffers is buffers
+            assert any(belief.belief_state is buffer for buffer in buffers)
+
+
+def test_discrete_memory_mask():
+    concept = LetterAddition(4)
+    space = concept.get_concept_space()
+    belief = create_test_belief_discrete(concept)
+
+    actions = [((0, 1), Actions.EXAMPLE), ((1, 2), Actions.QUIZ), ((0, 2), Actions.FEEDBACK), ((2, 3), Actions.EXAMPLE)]
+    states = []
+    for equation, action_type in actions:
+        states.append(belief.get_state())
+        belief.update_belief(action_type, (equation, concept.evaluate_concept(equation)), None)
+
+        expected = [belief.matches_memory(space[idx], idx) for idx in range(len(space))]
+        assert np.all(belief.matches_memory_batch(np.arange(len(space))) == expected)
+
+    # quizzes are not memorized, the oldest example was dropped
+    assert [item[1][0] for item in belief.memory] == [(0, 2), (2, 3)]
+
+    belief.set_state(states[2])
+    assert [item[1][0] for item in belief.memory] == [(0, 1)]
+    assert np.all(belief.get_transition_memory_mask() == (concept.state_action_values[(0, 1)]
+                                                          == concept.evaluate_concept((0, 1))))
+
+
+def test_checkpoint_rollback():
+    concept = NumberGame()
+    prior = concept.get_default_prior()
 
+    for belief in [MemorylessModel(prior.copy(), prior, concept),
+                   MemorylessModel(prior.copy(), prior, concept, sparse_limit=1.),
+                   DiscreteMemoryModel(prior.copy(), prior, concept, memory_size=2),
+                   ContinuousModel(prior, concept, particle_num=4)]:
+        belief.update_belief(Actions.EXAMPLE, (14, 1), None)
+
+        outer_state = belief.get_state()
+        outer = belief.checkpoint()
+        belief.update_belief(Actions.EXAMPLE, (21, 1), None)
+
+        inner_state = belief.get_state()
+        inner = belief.checkpoint()
+        for _ in range(2):
+            belief.update_belief(Actions.FEEDBACK, (28, 1), 0)
+            belief.rollback(inner)
+            assert_same_state(belief, inner_state)
+
+        belief.release(inner)
+        belief.rollback(outer)
+        assert_same_state(belief, outer_state)
+
+        belief.update_belief(Actions.QUIZ, (50, None), 1)
+        belief.rollback(outer)
+        assert_same_state(belief, outer_state)
+        belief.release(outer)
+
+        assert len(belief.checkpoints) == 0
+
+
+def assert_same_state(belief, state):
+    copy = belief.copy()
+    copy.set_state(state)
+
+    for idx in [0, 17, 1509]:
+        assert np.isclose(belief.get_concept_prob(idx), copy.get_concept_prob(idx))
+    assert np.isclose(belief.get_observation_prob((7, None), 1), copy.get_observation_prob((7, None), 1))
+
+
+def test_single_precision_belief():
+    concept = NumberGame()
+    prior = concept.get_default_prior()
+
+    for model, kwargs in [(MemorylessModel, {}), (DiscreteMemoryModel, {'memory_size': 2})]:
+        double = model(prior.copy(), prior, concept, **kwargs)
+        single = model(prior.copy(), prior, concept, dtype=np.float32, **kwargs)
+        assert single.prior.dtype == np.float32 and single.prior is concept.get_prior(np.float32)
+
+        for action_type, action, response in [(Actions.EXAMPLE, (14, 1), None), (Actions.QUIZ, (21, None), 1),
+                                              (Actions.FEEDBACK, (50, 0), 1), (Actions.EXAMPLE, (28, 1), None)]:
+            double.update_belief(action_type, action, response)
+            single.update_belief(action_type, action, response)
+
+            assert single.belief_state.dtype == np.float32
+            assert np.isclose(np.sum(single.belief_state), 1., atol=1e-5)
+            assert np.allclose(single.belief_state, double.belief_state, atol=1e-6)
+
+        assert single.copy().belief_state.dtype == np.float32
+
+    single = ContinuousModel(prior, concept, particle_num=4, dtype=np.float32)
+    for item in [14, 21, 50]:
+        single.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+    assert single.particle_dists.dtype == np.float32
+    assert np.allclose(np.sum(single.particle_dists, axis=1), 1., atol=1e-5)
+
+
+def test_belief_fingerprint():
+    concept = NumberGame()
+    prior = concept.get_default_prior()
+
+    for belief in [MemorylessModel(prior.copy(), prior, concept), DiscreteMemoryModel(prior.copy(), prior, concept, 2),
+                   ContinuousModel(prior, concept, particle_num=4)]:
+        other = belief.copy()
+        start = belief.fingerprint()
+        assert other.fingerprint() == start
+
+        belief.update_belief(Actions.EXAMPLE, (14, 1), None)
+        other.update_belief(Actions.EXAMPLE, (14, 1), None)
+        assert belief.fingerprint() == other.fingerprint() != start
+
+        checkpoint = belief.checkpoint()
+        belief.update_belief(Actions.QUIZ, (21, None), 1)
+        assert belief.fingerprint() != other.fingerprint()
+        belief.rollback(checkpoint)
+        assert belief.fingerprint() == other.fingerprint()
+        belief.release(checkpoint)
+
+        belief.update_belief(Actions.EXAMPLE, (28, 1), None)
+        assert belief.fingerprint() != other.fingerprint()
+
+
+def test_concept_prob_evaluator():
+    rand_ng.seed(5)
+
+    for concept in [LetterAddition(4), NumberGame()]:
+        prior = concept.get_default_prior()
+        observations = concept.get_observation_space()
+        true_idx = concept.get_true_concept_idx()
+
+        for belief in [MemorylessModel(prior.copy(), prior, concept), MemorylessModel(prior.copy(), prior, concept,
+                                                                                      sparse_limit=1.),
+                       DiscreteMemoryModel(prior.copy(), prior, concept, memory_size=2),
+                       ContinuousModel(prior, concept, particle_num=4),
+                       ContinuousModel(prior, concept, particle_num=4, merge_particles=True),
+                       ContinuousModel(prior, concept, particle_num=8, kl_bound=0.05)]:
+            for step in range(4):
+                items = [concept.rl_actions[i] for i in rand_ng.rg.choice(len(concept.rl_actions), 4)]
+
+                checkpoint = belief.checkpoint()
+                fingerprint = belief.fingerprint()
+                concept_prob = belief.concept_prob_evaluator(true_idx, checkpoint)
+
+                for action_type in [Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK]:
+                    for item in items:
+                        action = (item, None if action_type == Actions.QUIZ else concept.evaluate_concept(item))
+
+                        for response in [None] if action_type == Actions.EXAMPLE else observations:
+                            prob = concept_prob(action_type, action, response)
+
+                            # exactly the same as the regular update
+                            belief.update_belief(action_type, action, response)
+                            assert prob == belief.get_concept_prob(true_idx) or np.isnan(prob)
+                            belief.rollback(checkpoint)
+
+                belief.release(checkpoint)
+                assert belief.fingerprint() == fingerprint
+
+                belief.update_belief(Actions.FEEDBACK, (items[0], concept.evaluate_concept(items[0])),
+                                     observations[step % len(observations)])
+
+
+def test_sample_hidden_state():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+    hypotheses = np.arange(len(prior))
+    item = concept.get_rl_actions()[0]
+
+    rand_ng.seed(1)
+    for belief in [MemorylessModel(prior.copy(), prior, concept, verbose=False),
+                   DiscreteMemoryModel(prior.copy(), prior, concept, 2, verbose=False),
+                   ContinuousModel(prior, concept, particle_num=4, verbose=False)]:
+        belief.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+        probs = belief.get_concept_prob(hypotheses)
+        fingerprint = belief.fingerprint()
+
+        checkpoint = belief.checkpoint()
+        sampled = np.zeros(len(hypotheses))
+        for _ in range(2000):
+            belief.sample_hidden_state()
+
+            if isinstance(belief, ContinuousModel):
+                assert belief.particle_count == 1 and belief.particle_weights[0] == 1
+            else:
+                assert np.count_nonzero(belief.belief_state) == 1
+
+            sampled += belief.get_concept_prob(hypotheses)
+            belief.rollback(checkpoint)
+
+        # the sampled states follow the belief, which is returned to its state
+        assert np.allclose(sampled / 2000, probs, atol=0.05)
+        assert belief.fingerprint() == fingerprint
+        belief.release(checkpoint)
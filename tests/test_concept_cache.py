@@ -0,0 +1,52 @@
+import numpy as np
+
+from concepts.concept_cache import ConceptCache
+from concepts.letter_addition import LetterAddition
+from concepts.number_game import NumberGame
+from random_ng import rand_ng
+
+
+def test_number_game_cache(tmp_path):
+    cache = ConceptCache(str(tmp_path))
+
+    uncached = NumberGame()
+    created = NumberGame(cache=cache)
+    loaded = NumberGame(target_concept='64-83', cache=cache)
+
+    assert len(list(tmp_path.iterdir())) == 1
+
+    for concept in [created, loaded]:
+        assert np.array_equal(concept.get_concept_space().membership, uncached.get_concept_space().membership)
+        assert np.array_equal(concept.get_default_prior(), uncached.get_default_prior())
+        assert np.array_equal(concept.action_values, uncached.action_values)
+
+    assert not loaded.action_values.flags['WRITEABLE']
+    assert loaded.get_true_concept_idx() == NumberGame(target_concept='64-83').get_true_concept_idx()
+
+
+def test_cache_keyed_by_configuration(tmp_path):
+    cache = ConceptCache(str(tmp_path))
+
+    NumberGame(cache=cache)
+    NumberGame(space_mode='orig', cache=cache)
+
+    rand_ng.seed(123)
+    LetterAddition(3, cache=cache)
+    LetterAddition(3, list(range(4)), cache=cache)
+
+    assert len(list(tmp_path.iterdir())) == 4
+
+
+def test_letter_addition_cache(tmp_path):
+    cache = ConceptCache(str(tmp_path))
+
+    rand_ng.seed(123)
+    uncached = LetterAddition(4, list(range(5)))
+    LetterAddition(4, list(range(5)), cache=cache)
+
+    rand_ng.seed(123)
+    loaded = LetterAddition(4, list(range(5)), cache=cache)
+
+    assert np.array_equal(loaded.get_concept_space(), uncached.get_concept_space())
+    assert np.array_equal(loaded.action_values, uncached.action_values)
+    assert loaded.get_true_concept_idx() == uncached.get_true_concept_idx()
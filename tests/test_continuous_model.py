@@ -1,6 +1,11 @@
+import itertools
+
 from actions import Actions
 from concepts.letter_addition import LetterAddition
+from concepts.number_game import NumberGame
+from learner_models.continuous import ContinuousModel
 from learner_models.memoryless import MemorylessModel
+from random_ng import rand_ng
 
 import numpy as np
 
@@ -37,3 +42,242 @@ def test_check_production_noise():
     # 3|4|6|7: 4 pairs: 96 matches
     # 5: 6 pairs: 144 matches
 
+
+def test_update_belief_batch():
+    rand_ng.seed(123)
+
+    for concept, options in itertools.product([LetterAddition(4), NumberGame()],
+                                              [{}, {'merge_particles': True}, {'kl_bound': 0.05}]):
+        observations = concept.get_observation_space()
+        model = ContinuousModel(concept.get_default_prior(), concept, particle_num=6, **options)
+
+        for _ in range(4):
+            items = [concept.rl_actions[i] for i in rand_ng.rg.choice(len(concept.rl_actions), 5)]
+
+            for action_type in [Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK]:
+                actions = [(item, None if action_type == Actions.QUIZ else concept.evaluate_concept(item))
+                           for item in items]
+                responses = [None if action_type == Actions.EXAMPLE else rand_ng.rg.choice(observations)
+                             for _ in items]
+
+                dists, weights = model.update_belief_batch(action_type, actions, responses)
+
+                state = model.get_state()
+                for idx, (action, response) in enumerate(zip(actions, responses)):
+                    model.update_belief(action_type, action, response)
+
+                    particle_count = len(model.particle_weights)
+                    assert np.allclose(weights[idx, :particle_count], model.particle_weights)
+                    assert np.all(weights[idx, particle_count:] == 0)
+                    assert np.allclose(dists[idx, :particle_count], model.particle_dists)
+
+                    model.set_state(state)
+
+            model.update_belief(Actions.EXAMPLE, (items[0], concept.evaluate_concept(items[0])), None)
+
+
+def test_select_top_particles():
+    weights = np.array([.1, .3, .1, .2, .1, .3, .05])
+
+    for count in range(1, len(weights)):
+        remaining = list(range(len(weights)))
+        while len(remaining) > count:
+            del remaining[int(np.argmin(weights[remaining]))]
+
+        assert list(ContinuousModel.select_top_particles(weights, count)) == remaining
+
+
+def particle_update_loop(model, dists, weights, action_type, result, response):
+    """
+    Reference for update_belief with one array per particle, summing up every particle on its own and dropping the
+    particle with the lowest weight one after another; None if the particles are depleted
+    """
+    concept = model.concept
+    values = concept.action_values[concept.get_action_index(result[0])]
+    dists, weights = [dist.copy() for dist in dists], list(weights)
+
+    def check_particles_valid():
+        if np.sum(weights) < model.particle_depletion_limit:
+            return False
+
+        while len(weights) > model.particle_num:
+            min_idx = int(np.argmin(weights))
+            del dists[min_idx]
+            del weights[min_idx]
+
+        weight_sum = np.sum(weights)
+        weights[:] = [weight / weight_sum for weight in weights]
+        return True
+
+    if response is not None:
+        for idx, particle in enumerate(dists):
+            p_z = np.sum(particle[values == response])
+            weights[idx] *= (1 - model.production_noise) * p_z + model.obs_noise_prob
+
+        if not check_particles_valid():
+            return None
+
+    if result[1] is not None:
+        split_dists, split_weights = [], []
+        for particle, weight in zip(dists, weights):
+            transitioned = particle.copy()
+            transitioned[values != result[1]] = 0
+            transitioned /= np.sum(transitioned)
+
+            split_dists += [particle, transitioned]
+            split_weights += [weight * model.transition_noise, weight * (1 - model.transition_noise)]
+        dists[:], weights[:] = split_dists, split_weights
+
+        if not check_particles_valid():
+            return None
+
+    return np.array(dists), np.array(weights)
+
+
+def test_particle_update_matches_loop():
+    # sequences with particles of tied weights, which are dropped by their order only if the weights are exactly the
+    # same as in the loop
+    for seed in [148, 278]:
+        rand_ng.seed(seed)
+        concept = LetterAddition(5)
+        model = ContinuousModel(concept.get_default_prior(), concept, particle_num=16)
+        items, observations = concept.get_rl_actions(), concept.get_observation_space()
+
+        for _ in range(8):
+            item = items[rand_ng.rg.integers(len(items))]
+            action_type = [Actions.EXAMPLE, Actions.QUIZ, Actions.FEEDBACK][rand_ng.rg.integers(3)]
+            result = (item, None if action_type == Actions.QUIZ else concept.evaluate_concept(item))
+            response = None if action_type == Actions.EXAMPLE else observations[rand_ng.rg.integers(len(observations))]
+
+            expected = particle_update_loop(model, model.particle_dists, model.particle_weights, action_type, result,
+                                            response)
+            if expected is None:
+                break
+
+            model.update_belief(action_type, result, response)
+            assert np.allclose(model.particle_weights, expected[1], rtol=0, atol=1e-12)
+            assert np.allclose(model.particle_dists, expected[0], rtol=0, atol=1e-12)
+
+
+def test_particle_matrix_state():
+    concept = NumberGame()
+    model = ContinuousModel(concept.get_default_prior(), concept, particle_num=4)
+
+    for item in [14, 21, 50]:
+        model.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+    assert len(model.particle_weights) == 4
+    assert np.isclose(np.sum(model.particle_weights), 1.)
+
+    state = model.get_state()
+    model.update_belief(Actions.QUIZ, (7, None), 0)
+    model.set_state(state)
+
+    assert np.array_equal(model.particle_dists, state[0]) and np.array_equal(model.particle_weights, state[1])
+    assert np.isclose(model.get_concept_prob(concept.get_true_concept_idx()),
+                      np.sum(state[1] * state[0][:, concept.get_true_concept_idx()]))
+
+
+def test_recreated_history_particle():
+    concept = NumberGame()
+    model = ContinuousModel(concept.get_default_prior(), concept, particle_num=4)
+
+    items = [14, 21, 50, 3]
+    for item in items:
+        model.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+    model.update_belief(Actions.QUIZ, (7, None), 1)
+
+    state = model.get_state()
+    model.recreate_particles()
+    assert len(model.particle_weights) == 2
+
+    # replay of the examples on the prior
+    expected = concept.get_default_prior().copy()
+    for item in items:
+        expected = model.transition_model(expected, None, Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+    assert np.allclose(model.particle_dists[1], expected)
+
+    model.set_state(state)
+    assert np.array_equal(model.history_mask, state[2])
+
+
+def test_merge_identical_particles():
+    concept = NumberGame()
+    model = ContinuousModel(concept.get_default_prior(), concept, particle_num=16, merge_particles=True)
+    reference = ContinuousModel(concept.get_default_prior(), concept, particle_num=16)
+
+    # repeated items do not eliminate anything new, so the transitioned particles are copies
+    for item in [14, 21, 14]:
+        for belief in [model, reference]:
+            belief.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+
+        dists = model.particle_dists
+        assert not any(np.allclose(dists[i], dists[j]) for i in range(len(dists)) for j in range(i))
+        assert np.isclose(np.sum(model.particle_weights), 1.)
+
+    # same mixture as without merging while no particles were dropped
+    assert len(model.particle_weights) < len(reference.particle_weights)
+    assert np.allclose(model.particle_weights @ model.particle_dists,
+                       reference.particle_weights @ reference.particle_dists)
+
+
+def test_kl_particle_budget():
+    assert ContinuousModel.kl_particle_count(np.array([.5, .3, .2]), 0.) == 3
+    assert ContinuousModel.kl_particle_count(np.array([.1, .85, .05]), -np.log(.85)) == 1
+    assert ContinuousModel.kl_particle_count(np.array([.1, .85, .05]), -np.log(.9)) == 2
+
+    concept = NumberGame()
+    model = ContinuousModel(concept.get_default_prior(), concept, particle_num=16, kl_bound=0.05)
+    for item in [14, 21, 50, 28]:
+        model.update_belief(Actions.EXAMPLE, (item, concept.evaluate_concept(item)), None)
+
+        assert len(model.particle_weights) <= 16
+        assert np.isclose(np.sum(model.particle_weights), 1.)
+
+    dists, weights = model.update_belief_batch(Actions.EXAMPLE, [(7, 1), (8, 0)], [None, None])
+    for idx, action in enumerate([(7, 1), (8, 0)]):
+        copy = model.copy()
+        copy.update_belief(Actions.EXAMPLE, action, None)
+        assert np.allclose(weights[idx] @ dists[idx], copy.particle_weights @ copy.particle_dists)
+
+
+def test_deduplicated_predictions():
+    concept = NumberGame(space_mode='orig')
+    deduped = NumberGame(space_mode='orig', dedup=True)
+
+    models = [ContinuousModel(concept.get_default_prior(), concept, verbose=False),
+              ContinuousModel(deduped.get_default_prior(), deduped, verbose=False)]
+
+    for action_type, action, observation in [(None, None, None), (Actions.EXAMPLE, (16, True), None),
+                                             (Actions.QUIZ, (49, None), 1), (Actions.FEEDBACK, (14, True), 1)]:
+        if action_type is not None:
+            for model in models:
+                model.update_belief(action_type, action, observation)
+
+        # same predictive distribution as the original space
+        for item in [1, 14, 21, 64, 100]:
+            probs = [model.get_observation_prob((item, None), 1) for model in models]
+            assert np.isclose(probs[0], probs[1], rtol=0, atol=1e-12)
+
+        # the merged entries carry the probability of all their original hypotheses
+        merged = np.bincount(deduped.get_concept_space().canonical_index, weights=models[0].particle_dists[0])
+        assert np.allclose(merged, models[1].particle_dists[0], rtol=0, atol=1e-12)
+
+
+def test_belief_update_formula():
+    concept = LetterAddition(4)
+    model = ContinuousModel(concept.get_default_prior(), concept, particle_num=64)
+
+    item = concept.rl_actions[3]
+    observation = concept.get_observation_space()[1]
+
+    # the vectorized filter works on the marginal belief of the particles
+    new_belief = model.belief_update_formula(Actions.QUIZ, (item, None), observation)
+    likelihood = model.observation_likelihood_vec(Actions.QUIZ, (item, None), observation)
+    assert np.allclose(new_belief, model.marginal_belief() * likelihood)
+
+    # without a particle limit, the transition matches the particle update for examples
+    result = (item, concept.evaluate_concept(item))
+    new_belief = model.belief_update_formula(Actions.EXAMPLE, result, None)
+
+    model.update_belief(Actions.EXAMPLE, result, None)
+    assert np.allclose(new_belief / np.sum(new_belief), model.marginal_belief())
@@ -0,0 +1,79 @@
+import numpy as np
+
+from actions import Actions
+from concepts.letter_addition import LetterAddition
+from learner_models.memoryless import MemorylessModel
+from planners.forward_search import ForwardSearchPlanner
+from random_ng import rand_ng
+
+
+def test_forward_search_transpositions():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+
+    costs = []
+    for transpositions in [False, True]:
+        belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+        planner = ForwardSearchPlanner(concept, Actions.all(), belief, transpositions=transpositions)
+
+        # all items are searched, so the tree does not depend on the random state
+        tree = {"children": []}
+        costs.append(planner.forward_plan(belief, tree, 2))
+
+        assert (planner.transposition_hits > 0) == transpositions
+
+    assert costs[0] == costs[1]
+
+
+def test_parallel_root_search():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+    belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+    belief.update_belief(Actions.EXAMPLE, ((0, 1), concept.evaluate_concept((0, 1))), None)
+
+    # all items are searched, so the costs do not depend on the random state
+    serial = ForwardSearchPlanner(concept, Actions.all(), belief)
+    serial_tree = {"children": []}
+    serial.forward_plan(belief.copy(), serial_tree, 2)
+
+    trees = []
+    for workers in [2, 3]:
+        rand_ng.seed(1)
+        planner = ForwardSearchPlanner(concept, Actions.all(), belief, workers=workers)
+
+        tree = {"children": []}
+        planner.forward_plan_parallel(belief, tree, 2)
+        planner.root_pool.close()
+
+        trees.append(tree)
+
+    assert np.all(trees[0]["costs"] == trees[1]["costs"])
+
+    # subtrees are pruned differently, but the best actions are the same
+    costs = trees[0]["costs"]
+    assert costs.min() == serial_tree["costs"].min()
+    assert np.all(np.flatnonzero(costs == costs.min()) ==
+                  np.flatnonzero(serial_tree["costs"] == serial_tree["costs"].min()))
+    assert [(node["item"], node["action"]) for node in trees[0]["children"]] == \
+           [(node["item"], node["action"]) for node in serial_tree["children"]]
+
+
+def test_forward_search_time_budget():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+    belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+
+    # the first search completes even without any time left
+    planner = ForwardSearchPlanner(concept, Actions.all(), belief, plan_samples=[3], time_budget=1e-9)
+    action = planner.choose_action()
+
+    assert action[0] in Actions.all()
+    assert planner.plan_duration_history[-1].depth == 1
+
+    planner = ForwardSearchPlanner(concept, Actions.all(), belief, plan_samples=[3], time_budget=0.2)
+    planner.choose_action()
+
+    duration, depth = planner.plan_duration_history[-1]
+    assert depth >= 2
+    assert duration < 1
+    assert planner.deadline is None and planner.item_orders is None
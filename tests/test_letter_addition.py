@@ -1,6 +1,8 @@
+import itertools
+
 import numpy as np
 
-from concepts.letter_addition import LetterAddition
+from concepts.letter_addition import LetterAddition, PermutationSpace
 from random_ng import rand_ng
 
 
@@ -47,3 +49,95 @@ def test_readable_format():
     output = concept.gen_readable_format((equation, result))
 
     assert output == "A + D = 4"
+
+
+def test_compact_action_table():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(4, list(range(5)))
+
+    assert concept.action_values.shape == (6, 120)
+    assert concept.action_values.dtype == np.int8
+
+    action = (1, 3)
+    assert concept.get_action_index(action) == 4
+    for idx, hypothesis in enumerate(concept.get_concept_space()):
+        assert concept.state_action_values[action][idx] == hypothesis[1] + hypothesis[3]
+
+
+def test_permutation_space():
+    numbers = [2, 3, 5, 7, 11]
+    expected = np.array(list(itertools.permutations(numbers, 3)))
+
+    space = PermutationSpace(numbers, 3)
+    space.CHUNK_SIZE = 7
+
+    assert len(space) == len(expected)
+    assert np.all(space[:] == expected)
+    assert np.all(np.array(list(space)) == expected)
+    assert np.all(space[[59, 3]] == expected[[59, 3]])
+
+    for idx, permutation in enumerate(expected):
+        assert np.all(space[idx] == permutation)
+        assert space.rank(permutation) == idx
+
+
+def test_true_concept_pos():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(6, list(range(8)))
+
+    assert np.all(concept.get_concept_space()[concept.get_true_concept_idx()] == concept.item_values)
+
+
+def test_action_table_longer_equations():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(5, list(range(6)), equation_length=3)
+    concept.all_concepts.CHUNK_SIZE = 50
+
+    values = concept.calc_action_values()
+
+    assert values.shape == (10, 720)
+    for action_idx, equation in enumerate(concept.get_rl_actions()):
+        for idx in range(0, 720, 13):
+            assert values[action_idx, idx] == concept.evaluate_equation(equation, concept.get_concept_space()[idx])
+
+    assert concept.get_observation_space() == list(range(3, 13))
+
+
+def test_evaluate_concepts():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(3, [-1, 0, 1])
+    space = concept.get_concept_space()
+
+    for action in concept.get_rl_actions():
+        values = concept.evaluate_concepts(action, [0, 3, 5])
+        for value, idx in zip(values, [0, 3, 5]):
+            assert value == concept.evaluate_equation(action, space[idx])
+            assert concept.evaluate_concept(action, space[idx], idx) == value
+
+    # sums of zero are valid values
+    assert concept.evaluate_concept((0, 2), space[0], 0) == 0
+
+
+def test_observation_partition():
+    rand_ng.seed(123)
+
+    concept = LetterAddition(4, list(range(6)))
+    weights = rand_ng.rg.random(len(concept.get_concept_space()))
+
+    for action in concept.get_rl_actions():
+        partition = concept.get_partition(action)
+        sums = partition.sums(weights)
+        prior_sums = concept.get_prior_sums(action)
+
+        for obs_idx, observation in enumerate(concept.get_observation_space()):
+            expected = np.flatnonzero(concept.state_action_values[action] == observation)
+
+            assert np.all(concept.get_consistent_indices(action, observation) == expected)
+            assert np.isclose(sums[obs_idx], np.sum(weights[expected]))
+            assert np.isclose(prior_sums[obs_idx], np.sum(concept.get_default_prior()[expected]))
+
+    assert len(concept.get_consistent_indices((0, 1), 100)) == 0
@@ -0,0 +1,39 @@
+import numpy as np
+
+from actions import Actions
+from concepts.letter_addition import LetterAddition
+from learner_models.continuous import ContinuousModel
+from planners.max_information_gain import MaxInformationGainPlanner
+from random_ng import rand_ng
+
+
+def test_batch_gains_match_sequential_updates():
+    concept = LetterAddition(5)
+    belief = ContinuousModel(concept.get_default_prior(), concept, verbose=False)
+    planner = MaxInformationGainPlanner(concept, [Actions.EXAMPLE], belief)
+
+    results = [(item, concept.evaluate_concept(item)) for item in concept.get_rl_actions()]
+    entropy_before = planner.calc_entropy(belief)
+
+    # gains of updating a copy of the belief with one example after the other
+    gains = []
+    for result in results:
+        model = belief.copy()
+        model.update_belief(Actions.EXAMPLE, result, None)
+        gains.append(entropy_before - planner.calc_entropy(model))
+    gains = np.array(gains)
+
+    batch_gains = entropy_before - planner.calc_example_entropies(belief, results)
+    assert np.allclose(batch_gains, gains, rtol=0, atol=1e-12)
+
+    # the same ties
+    ties = np.flatnonzero(gains == gains.max())
+    assert len(ties) > 1
+    assert np.all(planner.max_gain_indices(batch_gains) == ties)
+
+    chosen = set()
+    for seed in range(40):
+        rand_ng.seed(seed)
+        chosen.add(planner.choose_action()[1])
+
+    assert chosen == {results[idx][0] for idx in ties}
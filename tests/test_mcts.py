@@ -0,0 +1,69 @@
+import numpy as np
+
+from actions import Actions
+from concepts.letter_addition import LetterAddition
+from learner_models.memoryless import MemorylessModel
+from planners.forward_search import ForwardSearchPlanner
+from planners.mcts import MCTSPlanner
+from random_ng import rand_ng
+
+
+def test_mcts_search():
+    concept = LetterAddition(6)
+    prior = concept.get_default_prior()
+    belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+    state = belief.get_state()
+
+    rand_ng.seed(1)
+    planner = MCTSPlanner(concept, Actions.all(), belief, simulations=50, max_depth=4)
+    root = planner.search(belief)
+
+    # the belief is returned to its state
+    assert np.all(belief.get_state() == state)
+
+    assert planner.simulation_count == 50
+    assert root.visits == 50
+    assert sum(child.visits for child in root.children) == 50
+
+    # items are widened progressively with the visits
+    assert len(root.items) == int(np.ceil(np.sqrt(49)))
+    assert len(root.children) == len(root.items) * len(Actions.all())
+
+    action = planner.choose_action()
+    assert action[0] in Actions.all()
+    assert action[2] == concept.evaluate_concept(action[1])
+    assert len(planner.plan_duration_history) == 1
+
+
+def test_mcts_time_budget():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+    belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+
+    planner = MCTSPlanner(concept, Actions.all(), belief, simulations=0, time_budget=0.05)
+    planner.choose_action()
+
+    assert planner.simulation_count > 0
+    assert planner.plan_duration_history[0] < 1
+
+
+def test_mcts_converges_to_forward_search():
+    concept = LetterAddition(3)
+    prior = concept.get_default_prior()
+    belief = MemorylessModel(prior.copy(), prior, concept, verbose=False)
+    belief.update_belief(Actions.EXAMPLE, ((0, 1), concept.evaluate_concept((0, 1))), None)
+
+    # all items are searched by both, so the best cost does not depend on the random state
+    forward = ForwardSearchPlanner(concept, Actions.all(), belief)
+    tree = {"children": []}
+    best_cost = forward.forward_plan(belief.copy(), tree, 1)
+
+    rand_ng.seed(1)
+    planner = MCTSPlanner(concept, Actions.all(), belief, simulations=1000, max_depth=1)
+    root = planner.search(belief.copy())
+
+    # the observations are sampled, but the most visited actions have (almost) all of them simulated
+    most_visited = max(root.children, key=lambda child: child.visits)
+    assert most_visited.complete
+    assert np.isclose(most_visited.cost, best_cost)
+    assert np.isclose(root.cost, best_cost)
@@ -0,0 +1,96 @@
+import numpy as np
+
+from concepts.number_game import NumberGame, NumberGameConcept
+
+
+def test_membership_matches_concepts():
+    concept = NumberGame()
+    space = concept.get_concept_space()
+
+    assert space.membership.shape == (len(space), 100)
+    assert len(space.concept_cache) == 0
+
+    for idx in range(0, len(space), 97):
+        expected = [NumberGameConcept(**space.specs[idx]).check(i) for i in range(1, 101)]
+        assert np.all(space.membership[idx] == expected), str(space[idx])
+
+
+def test_concepts_created_lazily():
+    concept = NumberGame()
+    space = concept.get_concept_space()
+
+    assert str(space[0]) == "odd numbers"
+    assert str(space[-1]) == "numbers between 100-100"
+    assert space[0] is space[0]
+    assert len(space.concept_cache) == 2
+
+
+def test_true_concept_idx():
+    for target, expected in [('mul7', NumberGameConcept(multiples=7)),
+                             ('64-83', NumberGameConcept(interval_start=64, interval_end=83)),
+                             ('mul4-1', NumberGameConcept(multiples=4, multiples_mod=-1))]:
+        for space_mode in ['default', 'orig']:
+            concept = NumberGame(target_concept=target, space_mode=space_mode)
+
+            assert concept.get_concept_space()[concept.get_true_concept_idx()] == expected
+
+
+def test_state_action_values():
+    concept = NumberGame()
+
+    assert np.isclose(np.sum(concept.get_default_prior()), 1.)
+    assert np.all(concept.state_action_values[14] == concept.get_concept_space().membership[:, 13])
+    assert concept.state_action_values[14][concept.get_true_concept_idx()] == 1
+    assert concept.evaluate_concept(14, concept.get_concept_space()[0], 0) == 0
+
+
+def test_compact_action_table():
+    concept = NumberGame()
+
+    assert concept.action_values.shape == (100, len(concept.get_concept_space()))
+    assert concept.action_values.dtype == np.int8
+    assert concept.action_values.flags['C_CONTIGUOUS']
+
+    assert concept.get_action_index(14) == 13
+    assert len(concept.state_action_values) == 100
+    assert np.all(concept.get_action_values([14, 21])[1] == concept.state_action_values[21])
+
+
+def test_concept_key_and_membership():
+    concept = NumberGameConcept(interval_start=90, interval_end=100)
+
+    assert not hasattr(concept, '__dict__')
+    assert 95 in concept and np.int64(100) in concept
+    assert 89 not in concept and 101 not in concept
+    assert concept.numbers_inside == list(range(90, 101))
+    assert concept == NumberGameConcept(interval_start=90, interval_end=100)
+    assert len({concept, NumberGameConcept(interval_start=90, interval_end=100)}) == 1
+
+
+def test_arbitrary_target_concept():
+    space = NumberGame().get_concept_space()
+
+    for idx in [0, 17, 350, len(space) - 1]:
+        target = NumberGameConcept(**space.specs[idx])
+        assert NumberGame(target_concept=target).get_true_concept_idx() == idx
+
+    assert NumberGame(target_concept=NumberGameConcept(multiples=7, multiples_start=3)).get_true_concept_idx() == -1
+
+
+def test_deduplicated_space():
+    for space_mode in ['default', 'orig']:
+        concept = NumberGame(space_mode=space_mode)
+        deduped = NumberGame(space_mode=space_mode, dedup=True)
+        space = deduped.get_concept_space()
+
+        assert len(np.unique(space.membership, axis=0)) == len(space) < len(concept.get_concept_space())
+        assert np.isclose(np.sum(deduped.get_default_prior()), 1.)
+
+        # same predictive distribution
+        for action in [1, 14, 64, 100]:
+            assert np.isclose(np.sum(concept.get_default_prior() * concept.state_action_values[action]),
+                              np.sum(deduped.get_default_prior() * deduped.state_action_values[action]))
+
+        true_idx = deduped.get_true_concept_idx()
+        assert space[true_idx] == NumberGameConcept(multiples=7)
+        assert all(alias == NumberGameConcept(multiples=7) for alias in space.get_aliases(true_idx))